@@ -0,0 +1,304 @@
+#
+#  benchmark of rpt commands with a synthetic repository
+#
+#   python bench.py [-n packages] [-f files] [--repeat N] [-o result.json]
+#                   [--baseline old.json [--threshold 0.2]]
+#
+#  a repository is generated (mkrepo.py) and served by the stand-in
+#  server (server.py), and then rpt is run as a separate process:
+#     update, install (download_all and extraction phases), list, search,
+#     upgrade (after new versions are published) and remove.
+#  rpt is run with '--json', and the phases are timed by its summary events.
+#  rpt installs packages into the drive of its working directory (\opt,
+#  \local and \opt\_pkgmgr), so it is run on a drive made by 'subst'
+#  (Windows only). --root gives the drive letter, a free one by default.
+#
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import statistics
+import subprocess
+import tempfile
+import string
+import re
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mkrepo
+from server import RepoServer
+
+RPT_SRC=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "rpt")
+
+#
+#  drive letter mapped to the directory, to install packages into \opt and \local
+class SubstDrive:
+  def __init__(self, path, letter=None):
+    self.path=path
+    self.letter=letter
+    self.drive=None
+
+  def __enter__(self):
+    os.makedirs(self.path, exist_ok=True)
+    for x in ([self.letter] if self.letter else reversed(string.ascii_uppercase[3:])):
+      if not os.path.exists(x+":\\"):
+        subprocess.check_call(["subst", x+":", self.path])
+        self.drive=x+":"
+        return self.drive+"\\"
+    if self.letter:
+      raise RuntimeError("Drive %s: is in use" % self.letter)
+    raise RuntimeError("No free drive letter")
+
+  def __exit__(self, *args):
+    if self.drive:
+      subprocess.call(["subst", self.drive, "/d"])
+
+#
+#  run rpt with '--json', events are time-stamped when they are read.
+#  a line which is not a JSON event is kept in 'output' as an error.
+def run_rpt(rpt_cmd, args, env, cwd):
+  t0=time.perf_counter()
+  proc=subprocess.Popen(rpt_cmd + ["--json"] + args, env=env, cwd=cwd,
+                        stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE, universal_newlines=True)
+  events=[]
+  output=[]
+  for line in proc.stdout:
+    try:
+      ev=json.loads(line)
+    except ValueError:
+      ev=None
+    if isinstance(ev, dict) and 'event' in ev:
+      ev['_t']=time.perf_counter() - t0
+      events.append(ev)
+    elif line.strip():
+      output.append(line.rstrip())
+  err=proc.stderr.read()
+  proc.wait()
+  wall=time.perf_counter() - t0
+  return { 'wall': wall, 'rc': proc.returncode, 'events': events, 'output': output, 'stderr': err[-2000:] }
+
+def event_time(res, kind, default=None):
+  for ev in res['events']:
+    if ev['event'] == kind: return ev['_t']
+  return default
+
+def count_events(res):
+  counts={}
+  for ev in res['events']:
+    counts[ev['event']]=counts.get(ev['event'], 0) + 1
+  return counts
+
+#
+#  phases of a command from the summary events
+def phases(name, res):
+  wall=res['wall']
+  if name == 'install':
+    t_dl=event_time(res, 'download_summary', 0)
+    return { 'download_all': t_dl, 'extract': event_time(res, 'install_summary', wall) - t_dl }
+  if name == 'update':
+    return { 'catalog': event_time(res, 'catalog', event_time(res, 'update', wall)) }
+  if name == 'upgrade':
+    evs=[x['_t'] for x in res['events'] if x['event'] == 'download']
+    t_dl=max(evs) if evs else 0
+    return { 'download': t_dl, 'upgrade': event_time(res, 'upgrade_summary', wall) - t_dl }
+  return {}
+
+#
+#  error events, unexpected output and the last line of stderr of a failed command
+def run_errors(res):
+  errors=[x.get('message') for x in res['events'] if x['event'] == 'error']
+  errors.extend(["unexpected output: " + x for x in res['output']])
+  if res['rc']:
+    errors.append("exit status %d: %s" % (res['rc'], (res['stderr'].strip().split("\n") or [""])[-1]))
+  return errors
+
+def summarize(name, res):
+  errors=run_errors(res)
+  return { 'wall': res['wall'], 'rc': res['rc'],
+           'phases': phases(name, res),
+           'events': count_events(res),
+           'errors': errors[:10], 'error_count': len(errors) }
+
+def print_errors(name, errors):
+  for x in errors:
+    print("    ERROR: %s: %s" % (name, x), flush=True)
+
+#
+#  steps which failed: [(name, error_count)]
+def failures(results):
+  return [(name, x['error_count']) for name, x in results.items() if x['rc'] or x['error_count']]
+
+#
+#  one pass of the benchmark with a clean RPT_HOME and install root
+def bench_once(args, server, workdir, rpt_cmd):
+  home=os.path.join(workdir, "home")
+  drive=os.path.join(workdir, "drive")
+  for x in (home, drive):
+    if os.path.exists(x): shutil.rmtree(x)
+  os.makedirs(home)
+  env=dict(os.environ)
+  env['RPT_HOME']=home
+  env['RPT_REPO_BASE']=server.base_url
+  env['PYTHONDONTWRITEBYTECODE']="1"
+
+  results={}
+  with SubstDrive(drive, args.root) as root:
+    def run(name, *cmd):
+      res=run_rpt(rpt_cmd, list(cmd), env, root)
+      results[name]=summarize(name, res)
+      print("  %-10s %8.3f sec  %s" % (name, res['wall'],
+            " ".join(["%s=%.3f" % x for x in results[name]['phases'].items()])), flush=True)
+      print_errors(name, results[name]['errors'])
+      return res
+
+    run('update', "update")
+    run('install', "install", args.package)
+    run('list', "list")
+    run('search', "search", "pkg_001")
+    #
+    # publish new versions, and upgrade
+    catalog=mkrepo.load_catalog(server.root)
+    bumped=mkrepo.bump_repo(server.root, args.bump, args.seed + len(args.results))
+    run('update2', "update")
+    run('upgrade', "upgrade")
+    results['upgrade']['bumped']=len(bumped)
+    #
+    # remove some of the installed packages
+    t=0
+    rc=0
+    errors=[]
+    names=[x['package'] for x in catalog if x['package'] not in mkrepo.META_PKGS][-args.remove:]
+    events={ 'remove': len(names) }
+    for x in names:
+      res=run_rpt(rpt_cmd, ["remove", x], env, root)
+      t += res['wall']
+      rc=rc or res['rc']
+      errors.extend(["%s: %s" % (x, e) for e in run_errors(res)])
+      for k, n in count_events(res).items():
+        events[k]=events.get(k, 0) + n
+    results['remove']={ 'wall': t, 'rc': rc, 'phases': { 'per_package': t/max(len(names), 1) },
+                        'errors': errors[:10], 'error_count': len(errors), 'events': events }
+    print("  %-10s %8.3f sec  (%d packages)" % ("remove", t, len(names)), flush=True)
+    print_errors("remove", errors[:10])
+    mkrepo.save_catalog(server.root, catalog)
+  return results
+
+#
+#  median of the repeated results
+def merge_results(runs):
+  res={}
+  for name in runs[0]:
+    walls=[x[name]['wall'] for x in runs if name in x]
+    res[name]=dict(runs[-1][name])
+    res[name]['wall']=statistics.median(walls)
+    res[name]['walls']=walls
+    res[name]['phases']=dict([(p, statistics.median([x[name]['phases'][p] for x in runs]))
+                              for p in runs[-1][name]['phases']])
+  return res
+
+def compare(result, baseline, threshold):
+  regressions=[]
+  for name, x in result.items():
+    old=baseline.get('results', {}).get(name)
+    if not old or old['wall'] <= 0: continue
+    ratio=x['wall']/old['wall']
+    if ratio > 1 + threshold:
+      regressions.append((name, old['wall'], x['wall'], ratio))
+  return regressions
+
+def git_revision():
+  try:
+    return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=RPT_SRC,
+                                   stderr=subprocess.DEVNULL, universal_newlines=True).strip()
+  except Exception:
+    return None
+
+#
+#
+def main():
+  import argparse
+  parser=argparse.ArgumentParser(description="benchmark of rpt commands")
+  parser.add_argument("-n", "--packages", type=int, default=2000)
+  parser.add_argument("-f", "--files", type=int, default=20)
+  parser.add_argument("-d", "--max-deps", type=int, default=6)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--bump", type=float, default=0.1, help="ratio of packages upgraded")
+  parser.add_argument("--remove", type=int, default=10, help="number of packages removed")
+  parser.add_argument("--package", default="ros_base", help="package to install")
+  parser.add_argument("--repeat", type=int, default=1)
+  parser.add_argument("--workdir", default=None, help="keep the repository in this directory")
+  parser.add_argument("--root", default=None, help="drive letter mapped to the install root by subst (default: a free one)")
+  parser.add_argument("--rpt", default=None, help="command to run rpt")
+  parser.add_argument("-o", "--output", default="bench_result.json")
+  parser.add_argument("--baseline", default=None)
+  parser.add_argument("--threshold", type=float, default=0.2)
+  args=parser.parse_args()
+  args.results=[]
+  if os.name != 'nt':
+    parser.error("rpt installs into the drive of its working directory, run on Windows")
+  if args.root:
+    if not re.match(r'^[A-Za-z]:?$', args.root):
+      parser.error("--root must be a drive letter (e.g. R:)")
+    args.root=args.root[0].upper()
+
+  rpt_cmd=args.rpt.split() if args.rpt else [sys.executable, os.path.join(RPT_SRC, "rpt.py")]
+  workdir=args.workdir or tempfile.mkdtemp(prefix="rpt_bench_")
+  repo=os.path.join(workdir, "repo")
+  params={ 'packages': args.packages, 'files': args.files, 'max_deps': args.max_deps, 'seed': args.seed }
+
+  pfile=os.path.join(repo, "params.json")
+  try:
+    with open(pfile) as f:
+      reuse=json.load(f) == params
+  except (OSError, ValueError):
+    reuse=False
+  if not reuse:
+    if os.path.exists(repo): shutil.rmtree(repo)
+    t0=time.perf_counter()
+    mkrepo.make_repo(repo, args.packages, args.files, args.max_deps, args.seed)
+    with open(pfile, 'w') as f:
+      json.dump(params, f)
+    print("Repository: %d packages (%.1f sec)" % (args.packages, time.perf_counter()-t0))
+
+  server=RepoServer(repo).start()
+  failed=[]
+  try:
+    for i in range(args.repeat):
+      print("Run %d/%d" % (i+1, args.repeat), flush=True)
+      args.results.append(bench_once(args, server, workdir, rpt_cmd))
+      failed=failures(args.results[-1])
+      if failed: break
+  finally:
+    server.stop()
+    if not args.workdir:
+      shutil.rmtree(workdir, ignore_errors=True)
+
+  #  the timings of a failed run are not saved nor compared
+  if failed:
+    for name, n in failed:
+      print("FAILED: %s (%d errors)" % (name, n))
+    sys.exit(1)
+
+  output={ 'params': params,
+           'repeat': args.repeat,
+           'revision': git_revision(),
+           'python': sys.version.split()[0],
+           'platform': platform.platform(),
+           'date': time.strftime("%Y-%m-%d %H:%M:%S"),
+           'results': merge_results(args.results) }
+  with open(args.output, 'w') as f:
+    json.dump(output, f, indent=2)
+  print("Result: %s" % args.output)
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions=compare(output['results'], json.load(f), args.threshold)
+    for name, old, new, ratio in regressions:
+      print("REGRESSION: %s %.3f -> %.3f sec (x%.2f)" % (name, old, new, ratio))
+    if regressions:
+      sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,139 @@
+#
+#  synthetic package repository for benchmarks
+#
+#   python mkrepo.py <dir> [-n packages] [-f files] [-d max_deps] [--seed N]
+#   python mkrepo.py <dir> --bump RATIO     (new versions of some packages)
+#
+#  <dir>/files/pkgs.yaml and <dir>/files/*.tgz are generated, the same
+#  seed gives the same repository (tarballs are written with fixed mtimes).
+#
+import os
+import io
+import gzip
+import tarfile
+import hashlib
+import random
+import yaml
+
+PKG_PREFIX="ros-melodic-"
+PKG_EXT=".tgz"
+META_PKGS=['ros_base', 'ros_desktop']
+
+#
+#
+def pkg_filename(name, version):
+  return "%s%s-%s%s" % (PKG_PREFIX, name.replace('_', '-'), version, PKG_EXT)
+
+#
+#  tarball with 'nfiles' small files under ros/melodic, contents depend
+#  on the package name and the version
+def make_tarball(fname, name, version, nfiles, rnd):
+  buf=io.BytesIO()
+  with tarfile.open(fileobj=buf, mode='w', format=tarfile.GNU_FORMAT) as tar:
+    for i in range(nfiles):
+      if i % 4 == 0:
+        path="ros/melodic/lib/%s/node_%d.py" % (name, i)
+      else:
+        path="ros/melodic/share/%s/%s/file_%d.txt" % (name, ["msg", "launch", "cfg"][i % 3], i)
+      size=rnd.choice([64, 256, 1024, 4096, 16384])
+      #  a quarter of the files changes with the version
+      tag=version if i % 4 == 1 else "1.0"
+      line=("%s %s %d\n" % (name, tag, i)).encode()
+      data=(line * (size // len(line) + 1))[:size]
+      info=tarfile.TarInfo(path)
+      info.size=len(data)
+      info.mtime=1500000000
+      info.mode=0o644
+      tar.addfile(info, io.BytesIO(data))
+  with open(fname, 'wb') as f:
+    with gzip.GzipFile(fileobj=f, mode='wb', mtime=0, filename="") as gz:
+      gz.write(buf.getvalue())
+  return get_md5(fname)
+
+def get_md5(fname):
+  md5=hashlib.md5()
+  with open(fname, 'rb') as f:
+    for chunk in iter(lambda: f.read(1024*1024), b''):
+      md5.update(chunk)
+  return md5.hexdigest()
+
+#
+#  packages are built in layers, each package depends on a few packages
+#  of the lower layers (a skewed fan-out like the ROS distribution).
+#  the meta packages depend on the top packages.
+def make_repo(root, npkgs=2000, nfiles=20, max_deps=6, seed=1):
+  rnd=random.Random(seed)
+  fdir=os.path.join(root, "files")
+  os.makedirs(fdir, exist_ok=True)
+  names=["pkg_%05d" % i for i in range(npkgs)]
+  entries=[]
+  for i, name in enumerate(names):
+    ndeps=min(int(rnd.expovariate(1.0/2)), max_deps, i)
+    lower=names[:i]
+    deps=sorted(set(rnd.sample(lower[-200:], ndeps))) if ndeps else []
+    entries.append(make_entry(fdir, name, "1.0", nfiles, deps, rnd))
+  depended=set()
+  for x in entries: depended.update(x['depend'])
+  top=[x['package'] for x in entries if not x['package'] in depended]
+  for i, name in enumerate(META_PKGS):
+    deps=top[i::len(META_PKGS)] or names[-1:]
+    entries.append(make_entry(fdir, name, "1.0", 1, deps, rnd))
+  save_catalog(root, entries)
+  return entries
+
+def make_entry(fdir, name, version, nfiles, deps, rnd):
+  fname=pkg_filename(name, version)
+  h_val=make_tarball(os.path.join(fdir, fname), name, version, nfiles, rnd)
+  return { 'package': name, 'version': version,
+           'filename': "ros_pkg/" + fname,
+           'description': "Synthetic package %s for benchmarks (%d files)" % (name, nfiles),
+           'maintainer': "bench <bench@example.com>",
+           'license': "BSD",
+           'depend': deps,
+           'MD5sum': h_val,
+           'nfiles': nfiles }
+
+#
+#  new versions of 'ratio' of the packages, old tarballs are kept
+def bump_repo(root, ratio=0.1, seed=2):
+  rnd=random.Random(seed)
+  fdir=os.path.join(root, "files")
+  entries=load_catalog(root)
+  pkgs=[x for x in entries if not x['package'] in META_PKGS]
+  bumped=[]
+  for x in rnd.sample(pkgs, max(int(len(pkgs)*ratio), 1)):
+    version="%.1f" % (float(x['version']) + 1)
+    x.update(make_entry(fdir, x['package'], version, x.get('nfiles', 20), x['depend'], rnd))
+    bumped.append(x['package'])
+  save_catalog(root, entries)
+  return bumped
+
+def load_catalog(root):
+  with open(os.path.join(root, "files", "pkgs.yaml")) as f:
+    return yaml.safe_load(f)
+
+def save_catalog(root, entries):
+  with open(os.path.join(root, "files", "pkgs.yaml"), 'w') as f:
+    yaml.safe_dump(entries, f, default_flow_style=False)
+
+#
+#
+def main():
+  import argparse
+  parser=argparse.ArgumentParser(description="generate a synthetic package repository")
+  parser.add_argument("root")
+  parser.add_argument("-n", "--packages", type=int, default=2000)
+  parser.add_argument("-f", "--files", type=int, default=20)
+  parser.add_argument("-d", "--max-deps", type=int, default=6)
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--bump", type=float, default=None)
+  args=parser.parse_args()
+  if args.bump is not None:
+    res=bump_repo(args.root, args.bump, args.seed)
+    print("%d packages bumped" % len(res))
+  else:
+    res=make_repo(args.root, args.packages, args.files, args.max_deps, args.seed)
+    print("%d packages" % len(res))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,300 @@
+#
+#  stand-in package repository server for benchmarks
+#
+#   python server.py <dir> [port] [--delay SEC] [--rate BYTES] [--fail RATIO] [--stall SEC]
+#
+#  serves <dir>/files (see mkrepo.py) with the CGIs used by rpt:
+#     pkg_download.cgi?name=<pkg>|list   tarball or pkgs.yaml (Range, ETag)
+#     pkg_dep.cgi?name=<pkg>             run_dep and lib_dep lines
+#     pkg_hash2.cgi?name=<pkg>           MD5 of the tarball
+#     pkg_list.cgi?name=<meta pkg>       packages of the meta package
+#     pkg_delta.cgi?since=<revision>     changes of pkgs.yaml since the revision
+#
+#  the catalog revision is counted up when pkgs.yaml is changed, and sent
+#  in 'X-Catalog-Revision' with the full list. a revision of another server
+#  run or older than the history gets '410 Gone'.
+#
+#  faults can be injected to test mirrors (several servers on other ports):
+#     delay   latency of each request in sec.
+#     rate    max. bytes/sec of a file
+#     fail    ratio of the requests answered with '503 Service Unavailable'
+#     stall   sec. to stop in the middle of each file
+#  they are attributes of RepoServer, and can be changed while serving.
+#
+import os
+import hashlib
+import threading
+import time
+import json
+import random
+import yaml
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+COPY_BUF_SIZE=1024*1024
+DELTA_HISTORY=100
+
+#
+#  pkgs.yaml of the repository, reloaded when the file is changed
+class Catalog:
+  def __init__(self, root):
+    self.fname=os.path.join(root, "files", "pkgs.yaml")
+    self.lock=threading.Lock()
+    self.stat=None
+    self.names={}
+    self.entries={}     # 'package' -> entry
+    self.md5=None
+    self.epoch="%x" % int(time.time())
+    self.revision=0
+    self.history=[]     # (revision, changed, removed)
+
+  def get(self):
+    with self.lock:
+      st=os.stat(self.fname)
+      if self.stat is None or (st.st_mtime_ns, st.st_size) != self.stat:
+        with open(self.fname, 'rb') as f:
+          data=f.read()
+        if self.md5 != hashlib.md5(data).hexdigest():
+          self.load(yaml.safe_load(data) or [])
+          self.md5=hashlib.md5(data).hexdigest()
+        self.stat=(st.st_mtime_ns, st.st_size)
+      return self.names
+
+  def load(self, data):
+    names={}
+    entries={}
+    for x in data:
+      entries[x['package']]=x
+      for p in x['package'].split(','):
+        names[p]=x
+    if self.revision:
+      changed=set([k for k, v in entries.items() if self.entries.get(k) != v])
+      removed=set([k for k in self.entries if not k in entries])
+      self.history.append((self.revision+1, changed, removed))
+      self.history=self.history[-DELTA_HISTORY:]
+    self.revision += 1
+    self.names=names
+    self.entries=entries
+
+  def revision_id(self):
+    return "%s-%d" % (self.epoch, self.revision)
+
+  #
+  #  changes since the revision, None if it is not in the history
+  def delta(self, since):
+    self.get()
+    with self.lock:
+      try:
+        epoch, rev=since.rsplit('-', 1)
+        rev=int(rev)
+      except ValueError:
+        return None
+      if epoch != self.epoch or rev > self.revision:
+        return None
+      if rev < self.revision and (not self.history or rev < self.history[0][0]-1):
+        return None
+      changed=set()
+      removed=set()
+      for r, c, d in self.history:
+        if r > rev:
+          changed |= c
+          removed |= d
+      return { 'revision': self.revision_id(),
+               'changed': [self.entries[x] for x in sorted(changed) if x in self.entries],
+               'removed': sorted([x for x in removed if not x in self.entries]),
+               'count': len(self.entries) }
+
+  def closure(self, name):
+    names=self.get()
+    res={}
+    stack=[name]
+    while stack:
+      x=stack.pop()
+      if x in res or not x in names: continue
+      res[x]=names[x]['MD5sum']
+      stack.extend(names[x].get('depend') or [])
+    return res
+
+#
+#
+class RepoHandler(BaseHTTPRequestHandler):
+  protocol_version="HTTP/1.1"
+
+  def log_message(self, *args):
+    self.server.requests += 1
+
+  def do_GET(self):
+    if self.server.delay:
+      time.sleep(self.server.delay)
+    if self.server.fail and random.random() < self.server.fail:
+      return self.send_error(503)
+    url=urlparse(self.path)
+    query=dict([(k, v[0]) for k, v in parse_qs(url.query).items()])
+    cgi=url.path.rsplit('/', 1)[-1]
+    name=query.get('name', '')
+    names=self.server.catalog.get()
+
+    if cgi == 'pkg_download.cgi':
+      if name == 'list':
+        return self.send_file("pkgs.yaml")
+      if name in names:
+        return self.send_file(os.path.basename(names[name]['filename']))
+    elif cgi == 'pkg_dep.cgi' and name in names:
+      return self.send_text(":".join(names[name].get('depend') or []) + "\n")
+    elif cgi == 'pkg_hash2.cgi' and name in names:
+      return self.send_text(names[name]['MD5sum'])
+    elif cgi == 'pkg_list.cgi':
+      return self.send_text(repr(self.server.catalog.closure(name)))
+    elif cgi == 'pkg_delta.cgi':
+      return self.send_delta(query.get('since', ''))
+    self.send_error(404)
+
+  def send_delta(self, since):
+    delta=self.server.catalog.delta(since)
+    if delta is None:
+      self.send_response(410)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+    elif delta['revision'] == since:
+      self.send_response(304)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+    else:
+      data=json.dumps(delta, default=str).encode()
+      self.send_response(200)
+      self.send_header('Content-Type', 'application/json')
+      self.send_header('Content-Length', str(len(data)))
+      self.end_headers()
+      self.wfile.write(data)
+
+  def send_text(self, text):
+    data=text.encode()
+    self.send_response(200)
+    self.send_header('Content-Type', 'text/plain')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  #
+  #  tarball or pkgs.yaml with ETag and Range support
+  def send_file(self, fname):
+    path=os.path.join(self.server.root, "files", fname)
+    h_val=self.server.get_md5(path)
+    etag='"%s"' % h_val
+    if self.headers.get('If-None-Match') == etag:
+      self.send_response(304)
+      self.send_header('ETag', etag)
+      self.send_header('Content-Length', '0')
+      self.end_headers()
+      return
+    size=os.path.getsize(path)
+    start, end=0, size-1
+    rng=self.headers.get('Range')
+    if rng and rng.startswith('bytes='):
+      a, b=rng[6:].split(',')[0].split('-')
+      start=int(a) if a else max(size-int(b), 0)
+      end=min(int(b), size-1) if a and b else size-1
+      if start >= size:
+        self.send_response(416)
+        self.send_header('Content-Range', 'bytes */%d' % size)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+        return
+      self.send_response(206)
+      self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+    else:
+      self.send_response(200)
+    self.send_header('Content-Type', 'application/octet-stream')
+    self.send_header('Content-Disposition', 'attachment; filename=%s' % fname)
+    self.send_header('Content-Length', str(end-start+1))
+    self.send_header('Content-MD5sum', h_val)
+    self.send_header('ETag', etag)
+    self.send_header('Accept-Ranges', 'bytes')
+    if fname == "pkgs.yaml":
+      self.send_header('X-Catalog-Revision', self.server.catalog.revision_id())
+    self.end_headers()
+    with open(path, 'rb') as f:
+      f.seek(start)
+      remain=end-start+1
+      stall_at=remain//2 if self.server.stall and remain > 1 else -1
+      t0=time.perf_counter()
+      sent=0
+      while remain > 0:
+        n=min(COPY_BUF_SIZE, remain)
+        if self.server.rate: n=min(n, max(self.server.rate//10, 1))
+        if stall_at >= 0 and sent < stall_at: n=min(n, stall_at-sent)
+        chunk=f.read(n)
+        if not chunk: break
+        self.wfile.write(chunk)
+        remain -= len(chunk)
+        sent += len(chunk)
+        if sent == stall_at:
+          self.wfile.flush()
+          time.sleep(self.server.stall)
+        if self.server.rate:
+          wait=sent/self.server.rate - (time.perf_counter()-t0)
+          if wait > 0: time.sleep(wait)
+
+#
+#
+class RepoServer(ThreadingHTTPServer):
+  daemon_threads=True
+
+  def __init__(self, root, port=0, delay=0, rate=0, fail=0, stall=0):
+    self.root=root
+    self.catalog=Catalog(root)
+    self.delay=delay
+    self.rate=rate
+    self.fail=fail
+    self.stall=stall
+    self.requests=0
+    self.md5={}
+    self.md5_lock=threading.Lock()
+    super().__init__(('127.0.0.1', port), RepoHandler)
+
+  @property
+  def base_url(self):
+    return "http://127.0.0.1:%d/cgi/" % self.server_address[1]
+
+  def get_md5(self, path):
+    st=os.stat(path)
+    key=(path, st.st_mtime_ns, st.st_size)
+    with self.md5_lock:
+      if not key in self.md5:
+        md5=hashlib.md5()
+        with open(path, 'rb') as f:
+          for chunk in iter(lambda: f.read(COPY_BUF_SIZE), b''):
+            md5.update(chunk)
+        self.md5[key]=md5.hexdigest()
+      return self.md5[key]
+
+  def start(self):
+    th=threading.Thread(target=self.serve_forever, daemon=True)
+    th.start()
+    return self
+
+  def stop(self):
+    self.shutdown()
+    self.server_close()
+
+#
+#
+def main():
+  import argparse
+  parser=argparse.ArgumentParser(description="stand-in package repository server")
+  parser.add_argument("root")
+  parser.add_argument("port", type=int, nargs='?', default=8080)
+  parser.add_argument("--delay", type=float, default=0, help="latency of each request in sec.")
+  parser.add_argument("--rate", type=int, default=0, help="max. bytes/sec of a file")
+  parser.add_argument("--fail", type=float, default=0, help="ratio of the requests failed with 503")
+  parser.add_argument("--stall", type=float, default=0, help="sec. to stop in the middle of a file")
+  args=parser.parse_args()
+  server=RepoServer(args.root, args.port, args.delay, args.rate, args.fail, args.stall)
+  print("Serving %s at %s" % (args.root, server.base_url), flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,129 @@
+#
+#  startup budget of rpt commands
+#
+#   python startup.py [--repeat N] [--scale X] [--rpt "python src/rpt/rpt.py"]
+#
+#  each command is run with '-X importtime', and the wall time, the import
+#  time of ros4win and the loaded modules are checked against the budget.
+#  commands which only read the local database must not load the network,
+#  YAML and archive modules. exits with 1 if a budget is exceeded.
+#
+import os
+import sys
+import json
+import time
+import shutil
+import statistics
+import subprocess
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mkrepo
+
+RPT_SRC=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src", "rpt")
+
+HEAVY_MODULES=['requests', 'urllib3', 'yaml', 'colorama', 'tarfile']
+
+#
+#  command: (arguments, wall time [ms], import time of ros4win [ms], modules not to be loaded)
+BUDGETS={
+  'help':   ([],                    150, 40, HEAVY_MODULES),
+  'check':  (["check", "pkg_00001"], 200, 40, HEAVY_MODULES),
+  'list':   (["list"],              200, 40, HEAVY_MODULES),
+  'search': (["search", "pkg_0001"], 250, 40, ['requests', 'urllib3', 'yaml', 'tarfile']),
+}
+
+#
+#  parse the output of '-X importtime': {module: (self, cumulative)} in usec
+def parse_importtime(text):
+  res={}
+  for line in text.splitlines():
+    if not line.startswith("import time:") or "|" not in line: continue
+    fields=line[12:].split("|")
+    try:
+      res[fields[2].strip()]=(int(fields[0]), int(fields[1]))
+    except ValueError:
+      continue
+  return res
+
+def run_once(rpt_cmd, args, env, cwd):
+  t0=time.perf_counter()
+  proc=subprocess.run(rpt_cmd[:1] + ["-X", "importtime"] + rpt_cmd[1:] + args,
+                      env=env, cwd=cwd, stdin=subprocess.DEVNULL,
+                      stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                      universal_newlines=True)
+  wall=(time.perf_counter() - t0)*1000
+  return wall, parse_importtime(proc.stderr)
+
+def measure(rpt_cmd, name, repeat, env, cwd):
+  args=BUDGETS[name][0]
+  run_once(rpt_cmd, args, env, cwd)      # warm up (bytecode, search index)
+  walls=[]
+  imports=[]
+  modules=set()
+  for i in range(repeat):
+    wall, mods=run_once(rpt_cmd, args, env, cwd)
+    walls.append(wall)
+    imports.append(mods.get('ros4win', (0, 0))[1]/1000.0)
+    modules.update(mods.keys())
+  return { 'wall': statistics.median(walls),
+           'import': statistics.median(imports),
+           'modules': len(modules),
+           'heavy': sorted([x for x in modules if x.split('.')[0] in HEAVY_MODULES]) }
+
+def check_budget(name, res, scale):
+  args, wall, imp, forbidden=BUDGETS[name]
+  errors=[]
+  if res['wall'] > wall*scale:
+    errors.append("wall %.1f ms > %.1f ms" % (res['wall'], wall*scale))
+  if res['import'] > imp*scale:
+    errors.append("import of ros4win %.1f ms > %.1f ms" % (res['import'], imp*scale))
+  loaded=sorted(set([x.split('.')[0] for x in res['heavy']]) & set(forbidden))
+  if loaded:
+    errors.append("loaded " + ", ".join(loaded))
+  return errors
+
+#
+#
+def main():
+  import argparse
+  parser=argparse.ArgumentParser(description="startup budget of rpt commands")
+  parser.add_argument("--repeat", type=int, default=5)
+  parser.add_argument("--scale", type=float, default=1.0, help="scale of the time budgets")
+  parser.add_argument("--rpt", default=None, help="command to run rpt")
+  parser.add_argument("-o", "--output", default=None)
+  args=parser.parse_args()
+
+  rpt_cmd=args.rpt.split() if args.rpt else [sys.executable, os.path.join(RPT_SRC, "rpt.py")]
+  workdir=tempfile.mkdtemp(prefix="rpt_startup_")
+  try:
+    #  a small catalog for 'search'
+    home=os.path.join(workdir, "home")
+    mkrepo.make_repo(os.path.join(workdir, "repo"), 200, 1)
+    os.makedirs(os.path.join(home, "__pkg__"))
+    shutil.copy(os.path.join(workdir, "repo", "files", "pkgs.yaml"), os.path.join(home, "__pkg__"))
+    env=dict(os.environ)
+    env['RPT_HOME']=home
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+
+    results={}
+    failed=False
+    for name in BUDGETS:
+      res=measure(rpt_cmd, name, args.repeat, env, workdir)
+      errors=check_budget(name, res, args.scale)
+      res['errors']=errors
+      results[name]=res
+      print("  %-8s wall %7.1f ms  import %6.1f ms  %3d modules  %s" %
+            (name, res['wall'], res['import'], res['modules'], "; ".join(errors) or "OK"))
+      failed = failed or bool(errors)
+  finally:
+    shutil.rmtree(workdir, ignore_errors=True)
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  if failed:
+    sys.exit(1)
+
+if __name__ == '__main__':
+  main()
@@ -1,5 +1,7 @@
 @setlocal
 @call %~d0\local\Python37\PyEnv.bat
+python -m compileall -b -q rpt\ros4win.py rpt\rpt.py
 python -m zipapp rpt -m "rpt:main"
+del rpt\ros4win.pyc rpt\rpt.pyc
 move /Y rpt.pyz ..
 @endlocal
\ No newline at end of file
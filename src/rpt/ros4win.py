@@ -3,23 +3,59 @@
 #     Copyright(C) 2019 Isao Hara
 import os
 import sys
-import requests
-import hashlib
-import sqlite3
-from contextlib import closing
+import importlib
+from contextlib import closing, contextmanager
+import functools
 import datetime
-import tarfile
+import time
 import glob
 import re
 import traceback
-import shutil
 import signal
-import yaml
 import re
-import colorama
-from colorama import Fore, Back, Style
-
-colorama.init(autoreset=True)
+import json
+import stat
+import threading
+import queue
+import io
+
+#
+#  modules imported on the first use, commands which only read the local
+#  database (e.g. 'rpt check', 'rpt list') do not load the network and YAML stack.
+class LazyModule:
+  def __init__(self, name):
+    self.__dict__['_name']=name
+    self.__dict__['_module']=None
+
+  def __getattr__(self, attr):
+    mod=self.__dict__['_module']
+    if mod is None:
+      mod=importlib.import_module(self.__dict__['_name'])
+      self.__dict__['_module']=mod
+    return getattr(mod, attr)
+
+requests=LazyModule('requests')
+hashlib=LazyModule('hashlib')
+sqlite3=LazyModule('sqlite3')
+tarfile=LazyModule('tarfile')
+yaml=LazyModule('yaml')
+colorama=LazyModule('colorama')
+tempfile=LazyModule('tempfile')
+shutil=LazyModule('shutil')
+futures=LazyModule('concurrent.futures')
+
+#
+#  Fore, Back and Style of colorama, colorama.init is called on the first use
+_colorama_ready=False
+
+def __getattr__(name):
+  global _colorama_ready
+  if name in ('Fore', 'Back', 'Style'):
+    if not _colorama_ready:
+      colorama.init(autoreset=True)
+      _colorama_ready=True
+    return getattr(colorama, name)
+  raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 PKG_LIST=['ros_base', 'ros_desktop', 'control', 'plan', 'navigation', 'robot']
 LIB_LIST=['local', 'local-contrib', 'python', 'setup', 'rtm']
@@ -30,10 +66,61 @@ PKG_EXT=".tgz"
 PKG_MGR_DIR="/opt/_pkgmgr"
 PKG_DB="ros4win.db"
 
-PKG_REPO_BASE="http://hara.jpn.com/cgi/"
+PKG_REPO_BASE=os.environ.get('RPT_REPO_BASE', "http://hara.jpn.com/cgi/")
+
+#
+# HTTP: (connect, read) timeout in sec. and retry count
+HTTP_TIMEOUT=(10, 60)
+HTTP_RETRIES=3
+
+#
+# download chunk size (adapted to the file size) and read buffer for hashing
+DL_CHUNK_MIN=64*1024
+DL_CHUNK_MAX=1024*1024
+HASH_BUF_SIZE=1024*1024
+HASH_CACHE_DB="hash_cache.db"
+
+#
+# number of files removed in one task
+REMOVE_BATCH_SIZE=256
+
+#
+# package cache (ros_pkg): index file and the max. size (RPT_CACHE_SIZE, e.g. 20G)
+PKG_CACHE_DB="pkg_cache.db"
+PKG_CACHE_SIZE=os.environ.get('RPT_CACHE_SIZE', '10G')
+
+#
+# search index of the catalog (__pkg__)
+SEARCH_DB="search.db"
+
+#
+# buffer to copy extracted files, and max. size of a file kept in memory
+# when it is compared with the installed file
+COPY_BUF_SIZE=1024*1024
+UPGRADE_SPOOL_SIZE=16*1024*1024
 
 PKG_MGR_DB="/opt/_pkgmgr/ros4win.db"
 
+#
+# number of concurrent downloads
+DL_WORKERS=4
+if os.environ.get('RPT_JOBS', '').isdigit():
+  DL_WORKERS=max(int(os.environ['RPT_JOBS']), 1)
+
+#
+# segmented download of a large file: number of concurrent byte ranges,
+# and min. size of a range (a file is split if it is twice as large)
+SEGMENT_WORKERS=4
+SEGMENT_MIN_SIZE=4*1024*1024
+if os.environ.get('RPT_SEGMENTS', '').isdigit():
+  SEGMENT_WORKERS=max(int(os.environ['RPT_SEGMENTS']), 1)
+
+#
+# number of packages extracted in parallel
+INSTALL_WORKERS=os.cpu_count() or 1
+if os.environ.get('RPT_INSTALL_JOBS', '').isdigit():
+  INSTALL_WORKERS=max(int(os.environ['RPT_INSTALL_JOBS']), 1)
+
 _mon=['-', '\\', '|', '/']
 _mon2=['| ', ' ~', ' |', '_ ']
 _mon_dot=['   ', '.  ', '.. ', '...', ' ..', '  .']
@@ -51,6 +138,198 @@ def getMonDots(n):
 def getMonDots2(n):
   return _mon_dot2[ n % 8 ]
 
+#
+# console output: 'text', 'quiet' (no progress and messages) or
+# 'json' (summary events only, one JSON object per line)
+OUTPUT_MODE='text'
+PROGRESS_INTERVAL=0.1
+
+#
+#  progress display, redrawn at most once in PROGRESS_INTERVAL.
+#  concurrent tasks (e.g. parallel downloads) are shown in one line.
+class Progress:
+  def __init__(self, interval=None):
+    self.interval=interval
+    self.lock=threading.Lock()
+    self.tasks={}
+    self.last=0
+    self.width=0
+    self.count=0
+
+  def update(self, key, done, total=0, label=None, force=False):
+    with self.lock:
+      task=self.tasks.setdefault(key, [label or key, 0, 0])
+      task[1]=done
+      if total: task[2]=total
+      if label: task[0]=label
+      self.render(force)
+
+  def finish(self, key):
+    with self.lock:
+      self.tasks.pop(key, None)
+      if not self.tasks: self.clear()
+
+  def render(self, force=False):
+    if OUTPUT_MODE != 'text' or not self.tasks: return
+    now=time.monotonic()
+    interval=PROGRESS_INTERVAL if self.interval is None else self.interval
+    if not force and now - self.last < interval: return
+    self.last=now
+    self.count += 1
+    items=[]
+    for label, done, total in list(self.tasks.values())[:2]:
+      if total:
+        pos=min(int(done*10/total), 10)
+        items.append("%s |%s|(%d%%)" % (label, "=" * pos + ">" + " " * (10-pos),
+                                         min(done*100//total, 100)))
+      else:
+        items.append("%s %s" % (label, getMonDots(self.count)))
+    line=" ".join(items)
+    if len(self.tasks) > 2: line += " (+%d)" % (len(self.tasks)-2)
+    line += " " + getMonChar(self.count)
+    sys.stdout.write("\r" + line + " " * max(self.width - len(line), 0))
+    sys.stdout.flush()
+    self.width=len(line)
+
+  def clear(self):
+    if self.width:
+      sys.stdout.write("\r" + " " * self.width + "\r")
+      sys.stdout.flush()
+      self.width=0
+
+  def message(self, *args):
+    with self.lock:
+      self.clear()
+      print(*args, flush=True)
+      self.render(True)
+
+_progress=Progress()
+
+def get_progress():
+  return _progress
+
+#
+#  messages are shown only in 'text' mode
+def message(*args):
+  if OUTPUT_MODE == 'text':
+    _progress.message(*args)
+
+def error(*args):
+  if OUTPUT_MODE == 'json':
+    event('error', message=" ".join([str(x).strip() for x in args]))
+  elif OUTPUT_MODE == 'quiet':
+    print(*args, file=sys.stderr, flush=True)
+  else:
+    _progress.message(*args)
+
+#
+#  summary event, printed only in 'json' mode
+def event(kind, **data):
+  if OUTPUT_MODE == 'json':
+    data['event']=kind
+    with _progress.lock:
+      print(json.dumps(data), flush=True)
+
+#
+#  profiler (--profile): time, bytes and call counts of each phase.
+#  spans are kept for the Chrome trace format (chrome://tracing) if required.
+#  a nested call of the same phase is counted in the outer span.
+class Profiler:
+  def __init__(self):
+    self.enabled=False
+    self.trace=False
+    self.lock=threading.Lock()
+    self.local=threading.local()
+    self.phases={}     # phase -> [calls, time, bytes]
+    self.spans=[]
+    self.t0=time.perf_counter()
+
+  def start(self, trace=False):
+    self.enabled=True
+    self.trace=trace
+    self.t0=time.perf_counter()
+
+  def stack(self):
+    if not hasattr(self.local, 'stack'):
+      self.local.stack=[]
+    return self.local.stack
+
+  @contextmanager
+  def span(self, phase, name=None):
+    stack=self.stack()
+    if not self.enabled or phase in [x[0] for x in stack]:
+      yield
+      return
+    item=[phase, 0]
+    stack.append(item)
+    start=time.perf_counter()
+    try:
+      yield
+    finally:
+      dur=time.perf_counter() - start
+      stack.pop()
+      with self.lock:
+        val=self.phases.setdefault(phase, [0, 0.0, 0])
+        val[0] += 1
+        val[1] += dur
+        val[2] += item[1]
+        if self.trace:
+          self.spans.append({ 'name': name or phase, 'cat': phase, 'ph': 'X',
+                              'ts': int((start - self.t0)*1000000), 'dur': int(dur*1000000),
+                              'pid': os.getpid(), 'tid': threading.get_ident(),
+                              'args': { 'bytes': item[1] } })
+
+  #
+  #  bytes processed in the current span of the thread
+  def add_bytes(self, n):
+    if self.enabled:
+      stack=self.stack()
+      if stack: stack[-1][1] += n
+
+  def report(self):
+    with self.lock:
+      phases=dict([(k, { 'calls': v[0], 'time': round(v[1], 6), 'bytes': v[2] })
+                   for k, v in self.phases.items()])
+    return { 'wall': round(time.perf_counter() - self.t0, 6), 'phases': phases }
+
+  def format_report(self):
+    res=self.report()
+    lines=["Profile: %.3f sec (phase times are summed over threads)" % res['wall'],
+           "   %-10s %8s %10s %12s %10s" % ("phase", "calls", "time[s]", "bytes", "MB/s")]
+    for k, v in sorted(res['phases'].items(), key=lambda x: -x[1]['time']):
+      rate=v['bytes']/v['time']/1024**2 if v['time'] > 0 and v['bytes'] else 0
+      lines.append("   %-10s %8d %10.3f %12d %10.1f" % (k, v['calls'], v['time'], v['bytes'], rate))
+    return "\n".join(lines)
+
+  def save_report(self, fname):
+    with open(fname, 'w') as f:
+      json.dump(self.report(), f, indent=2)
+
+  def save_trace(self, fname):
+    with self.lock:
+      data={ 'traceEvents': list(self.spans), 'displayTimeUnit': 'ms' }
+    with open(fname, 'w') as f:
+      json.dump(data, f)
+
+PROFILER=Profiler()
+
+def profiled(phase):
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      if not PROFILER.enabled:
+        return func(*args, **kwargs)
+      with PROFILER.span(phase, func.__name__):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+#
+#  signal handler can be set only in the main thread
+def reset_sigint():
+  if threading.current_thread() is threading.main_thread():
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+
 #
 #
 def getRptDir():
@@ -64,12 +343,269 @@ def getRptDir():
     return dirname
 
 
+#######
+# HTTP session
+#
+_session=None
+_session_lock=threading.Lock()
+
+def get_session():
+  global _session
+  with _session_lock:
+    if _session is None:
+      from requests.adapters import HTTPAdapter
+      from urllib3.util.retry import Retry
+      #  failed requests are retried by the next mirror if there are
+      retries=HTTP_RETRIES if len(get_mirrors().bases) < 2 else 1
+      retry=Retry(total=retries, backoff_factor=0.5,
+                  status_forcelist=(500, 502, 503, 504))
+      adapter=HTTPAdapter(pool_connections=4, pool_maxsize=max(DL_WORKERS, 4)*SEGMENT_WORKERS,
+                          max_retries=retry)
+      _session=requests.Session()
+      _session.mount('http://', adapter)
+      _session.mount('https://', adapter)
+  return _session
+
+def http_get(url, **kwargs):
+  kwargs.setdefault('timeout', HTTP_TIMEOUT)
+  return get_session().get(url, **kwargs)
+
+#######
+# Mirrors
+#
+#  the repository is served by the mirrors in RPT_MIRRORS (base URLs
+#  separated by ',') or in mirrors.txt (one base URL in a line), and by
+#  PKG_REPO_BASE if none is given. they are ranked by the measured round
+#  trip time and throughput, kept in __pkg__\mirrors.json across runs.
+#  a mirror which fails is tried last for MIRROR_BACKOFF sec. (doubled for
+#  each failure in a row).
+MIRROR_FILE="mirrors.txt"
+MIRROR_STATS="mirrors.json"
+MIRROR_PROBE_INTERVAL=24*3600
+MIRROR_PROBE_TIMEOUT=(3, 5)
+MIRROR_STALL_TIMEOUT=15
+MIRROR_BACKOFF=30
+MIRROR_BACKOFF_MAX=3600
+MIRROR_EWMA=0.3
+MIRROR_DEFAULT_RTT=0.5
+MIRROR_REF_SIZE=1024*1024     # file size to estimate the download time
+MIRROR_MIN_SAMPLE=256*1024    # min. size of a download to measure throughput
+
+def get_mirror_list():
+  if os.environ.get('RPT_MIRRORS'):
+    lst=re.split(r'[,\s]+', os.environ['RPT_MIRRORS'])
+  else:
+    try:
+      with open(getRptDir()+"\\"+MIRROR_FILE) as f:
+        lst=[x.split('#')[0].strip() for x in f]
+    except OSError:
+      lst=[]
+  res=[]
+  for x in lst:
+    if not x: continue
+    if not x.endswith('/'): x += '/'
+    if not x in res: res.append(x)
+  return res or [PKG_REPO_BASE]
+
+def ewma(old, val):
+  if old is None: return val
+  return old*(1-MIRROR_EWMA) + val*MIRROR_EWMA
+
+#
+#  statistics of the mirrors:
+#    rtt, throughput (bytes/sec), ok, failed, errors (failures in a row),
+#    retry_at (time when a failed mirror is ranked again), probed (time)
+class MirrorSet:
+  def __init__(self, bases, fname=None):
+    self.bases=bases
+    self.fname=fname
+    self.lock=threading.Lock()
+    self.active=dict([(x, 0) for x in bases])
+    self.stats={}
+    self.dirty=False
+    self.load()
+
+  def load(self):
+    try:
+      with open(self.fname, "r") as f:
+        data=json.load(f)
+    except (OSError, TypeError, ValueError):
+      data={}
+    for x in self.bases:
+      st={ 'rtt': None, 'throughput': None, 'ok': 0, 'failed': 0, 'errors': 0,
+           'retry_at': 0, 'probed': 0 }
+      if isinstance(data.get(x), dict): st.update(data[x])
+      self.stats[x]=st
+
+  def save(self):
+    if not self.fname or not self.dirty: return
+    with self.lock:
+      data=json.dumps(self.stats, indent=1)
+      self.dirty=False
+    try:
+      os.makedirs(os.path.dirname(self.fname), exist_ok=True)
+      with open(self.fname, "w") as f:
+        f.write(data)
+    except OSError:
+      pass
+
+  #
+  #  expected time to download MIRROR_REF_SIZE bytes, multiplied by the
+  #  number of the downloads in progress to spread them over the mirrors
+  def score(self, base):
+    st=self.stats[base]
+    t=st['rtt'] if st['rtt'] is not None else MIRROR_DEFAULT_RTT
+    if st['throughput']: t += MIRROR_REF_SIZE/st['throughput']
+    return t*(1+self.active[base])
+
+  def ranked(self):
+    now=time.time()
+    return sorted(self.bases, key=lambda x: (self.stats[x]['retry_at'] > now, self.score(x)))
+
+  #
+  #  mirrors in the order to be tried, 'prefer' first
+  def order(self, prefer=None):
+    with self.lock:
+      res=self.ranked()
+    if prefer in res:
+      res.remove(prefer)
+      res.insert(0, prefer)
+    return res
+
+  #
+  #  the best mirror for a download, released when it is finished
+  def acquire(self):
+    with self.lock:
+      base=self.ranked()[0]
+      self.active[base] += 1
+    return base
+
+  def release(self, base):
+    with self.lock:
+      self.active[base] -= 1
+
+  def success(self, base, rtt=None):
+    with self.lock:
+      st=self.stats[base]
+      if rtt is not None: st['rtt']=ewma(st['rtt'], rtt)
+      st['ok'] += 1
+      st['errors']=0
+      st['retry_at']=0
+      self.dirty=True
+
+  def transfer(self, base, size, sec):
+    if size < MIRROR_MIN_SAMPLE or sec <= 0: return
+    with self.lock:
+      st=self.stats[base]
+      st['throughput']=ewma(st['throughput'], size/sec)
+      self.dirty=True
+
+  def failure(self, base, err=None):
+    with self.lock:
+      st=self.stats[base]
+      st['failed'] += 1
+      st['errors'] += 1
+      st['retry_at']=time.time() + min(MIRROR_BACKOFF*2**(st['errors']-1), MIRROR_BACKOFF_MAX)
+      self.dirty=True
+    event('mirror', mirror=base, error=str(err) or err.__class__.__name__)
+
+  #
+  #  measure the round trip time of the mirrors which are not probed in
+  #  MIRROR_PROBE_INTERVAL (all of them if force), in parallel
+  def probe(self, force=False):
+    now=time.time()
+    targets=[x for x in self.bases if force or now - self.stats[x]['probed'] > MIRROR_PROBE_INTERVAL]
+    if not targets: return
+    get=requests.get    # not to count the import in the first probe
+
+    def _probe(base):
+      t=time.perf_counter()
+      try:
+        res=get(base+"pkg_hash2.cgi?name="+PKG_LIST[0], timeout=MIRROR_PROBE_TIMEOUT)
+        res.close()
+      except requests.RequestException as e:
+        return base, None, e
+      if res.status_code >= 500:
+        return base, None, "HTTP %d" % res.status_code
+      return base, time.perf_counter()-t, None
+
+    with futures.ThreadPoolExecutor(max_workers=len(targets)) as ex:
+      for base, rtt, err in ex.map(_probe, targets):
+        self.stats[base]['probed']=now
+        if rtt is None: self.failure(base, err)
+        else: self.success(base, rtt)
+
+_mirrors=None
+_mirrors_lock=threading.Lock()
+
+#
+#  mirrors are probed on the first use if there are more than one
+def get_mirrors():
+  global _mirrors
+  with _mirrors_lock:
+    if _mirrors is None:
+      _mirrors=MirrorSet(get_mirror_list(), getRptDir()+"\\__pkg__\\"+MIRROR_STATS)
+      if len(_mirrors.bases) > 1:
+        _mirrors.probe()
+  return _mirrors
+
+def save_mirrors():
+  if _mirrors is not None:
+    _mirrors.save()
+
+#
+#  GET base+query from the best mirror, and the next one if it fails,
+#  stalls (no data in MIRROR_STALL_TIMEOUT sec.) or has not the file.
+#  the mirror is set to 'mirror' of the response.
+def repo_get(query, prefer=None, **kwargs):
+  mirrors=get_mirrors()
+  bases=mirrors.order(prefer)
+  if len(bases) > 1:
+    kwargs.setdefault('timeout', (HTTP_TIMEOUT[0], MIRROR_STALL_TIMEOUT))
+  res=None
+  err=None
+  for i, base in enumerate(bases):
+    if res is not None: res.close()
+    t=time.perf_counter()
+    try:
+      res=http_get(base+query, **kwargs)
+    except requests.RequestException as e:
+      mirrors.failure(base, e)
+      res=None
+      err=e
+      continue
+    res.mirror=base
+    if res.status_code >= 500:
+      mirrors.failure(base, "HTTP %d" % res.status_code)
+      continue
+    mirrors.success(base, time.perf_counter()-t)
+    if res.status_code == 404 and i < len(bases)-1:
+      continue
+    return res
+  if res is None: raise err
+  return res
+
+#
+#  validators (ETag/Last-Modified) of conditional GET, saved as json
+def load_http_validators(fname):
+  try:
+    with open(fname, "r") as f:
+      return json.load(f)
+  except:
+    return {}
+
+def save_http_validators(fname, data):
+  try:
+    with open(fname, "w") as f:
+      json.dump(data, f, indent=1)
+  except:
+    pass
+
 #######
 # Remote
 #
 def get_pkg_hash_value(name):
-  url="%spkg_hash2.cgi?name=%s" % (PKG_REPO_BASE, name)
-  res=requests.get(url)
+  res=repo_get("pkg_hash2.cgi?name=%s" % name)
   if res.status_code == 200:
     return res.text
   return ""
@@ -82,33 +618,162 @@ def get_attached_filename(response, filename, path=""):
       filename=val.split('filename=')[-1]
   size=int(response.headers['Content-Length'])
   if path :
-    if not os.path.exists(path) :
-      os.makedirs(path)
+    os.makedirs(path, exist_ok=True)
     filename = path+"\\"+filename
   return filename, size
+
+#
+#  (first byte, total size) of the partial content
+def get_content_range(response):
+  m=re.match(r'bytes\s+(\d+)-(\d+)/(\d+)', response.headers.get('Content-Range', ''))
+  if m :
+    return int(m.group(1)), int(m.group(3))
+  return None, None
 #  
 #
-def save_download_file(response, file_name, size, dl_chunk_size):
-  #mon=['-', '\\', '|', '/']
-  count = 1
-  bs=10
+def get_chunk_size(size):
+  return min(max(int(size / 64), DL_CHUNK_MIN), DL_CHUNK_MAX)
+
+#
+#  save the response to 'file_name.part' with computing MD5, then rename it
+#  to file_name if the hash matches h_val. if offset > 0, the response is
+#  the rest of the file and it is appended to the .part file.
+#  returns MD5 of the file, or None if mismatched
+def save_download_file(response, file_name, size, dl_chunk_size, verbose=True, h_val=None, offset=0):
+  received=offset
+  label="Download %s:" % os.path.basename(file_name)
+  md5=hashlib.md5()
+  part_name=file_name+".part"
+  mode='wb'
+  if offset:
+    mode='r+b'
+    with open(part_name, 'rb') as f:
+      while received > f.tell():
+        chunk=f.read(min(HASH_BUF_SIZE, received - f.tell()))
+        if not chunk: break
+        md5.update(chunk)
   #
-  # save to file
-  with open(file_name, 'wb') as f:
+  # save to file, the .part file is kept to resume when interrupted
+  with open(part_name, mode) as f:
+    if offset:
+      f.truncate(offset)
+      f.seek(offset)
     for chunk in response.iter_content(chunk_size=dl_chunk_size):
       f.write(chunk)
-      remain = (size - dl_chunk_size * count) / size
-      n = min(int((1-remain)*bs), bs)
-      bar="=" * n + ">" + " " * (bs -n)
-      print( "\rDownload %s:|%s|(%d%%) %s" % (os.path.basename(file_name), bar, min(100- remain*100, 100), getMonChar(count)), end="")
-      count += 1
-  return
+      md5.update(chunk)
+      received += len(chunk)
+      if verbose:
+        _progress.update(file_name, received, size, label)
+  _progress.finish(file_name)
+  PROFILER.add_bytes(received - offset)
+
+  h_val2=md5.hexdigest()
+  if h_val and h_val.strip() != h_val2:
+    os.remove(part_name)
+    error("MD5 mismatch: %s" % os.path.basename(file_name))
+    return None
+  os.replace(part_name, file_name)
+  get_hash_cache().store(file_name, os.stat(file_name), h_val2)
+  return h_val2
+
+#
+#  download a large file in byte ranges over SEGMENT_WORKERS connections
+#  (spread over the mirrors), written in place to the preallocated .part
+#  file. the first range is read from the response. a range is resumed
+#  with the next mirror if it fails, and the whole file is downloaded in
+#  one stream if a range is not served.
+#  returns MD5 of the file, or None if mismatched
+def save_segmented_file(response, query, file_name, size, verbose=True, h_val=None, workers=None):
+  if workers is None: workers=SEGMENT_WORKERS
+  nseg=max(min(workers, size // SEGMENT_MIN_SIZE), 1)
+  bounds=[size*i//nseg for i in range(nseg+1)]
+  label="Download %s:" % os.path.basename(file_name)
+  part_name=file_name+".part"
+  mirrors=get_mirrors()
+  lock=threading.Lock()
+  received=[0]
+  no_range=threading.Event()
+  with open(part_name, 'wb') as f:
+    f.truncate(size)
+
+  def _write(res, f, pos, end):
+    for chunk in res.iter_content(chunk_size=get_chunk_size(end-pos)):
+      chunk=chunk[:end-pos]
+      f.write(chunk)
+      pos += len(chunk)
+      with lock:
+        received[0] += len(chunk)
+        if verbose:
+          _progress.update(file_name, received[0], size, label)
+      if pos >= end or no_range.is_set(): break
+    return pos
+
+  def _segment(i):
+    pos, end=bounds[i], bounds[i+1]
+    res=response if i == 0 else None
+    mirror=acquired=mirrors.acquire()
+    tries=len(mirrors.bases)+1
+    try:
+      with open(part_name, 'r+b') as f:
+        f.seek(pos)
+        while pos < end:
+          if no_range.is_set(): return False
+          try:
+            if res is None:
+              res=repo_get(query, prefer=mirror, stream=True,
+                           headers={'Range': "bytes=%d-%d" % (pos, end-1)})
+              if res.status_code != 206 or get_content_range(res) != (pos, size):
+                no_range.set()
+                return False
+            t=time.perf_counter()
+            start=pos
+            pos=_write(res, f, pos, end)
+            mirrors.transfer(res.mirror, pos-start, time.perf_counter()-t)
+          except requests.RequestException as e:
+            if res is not None: mirrors.failure(res.mirror, e)
+            pos=f.tell()
+            tries -= 1
+            if tries <= 0: raise
+            mirror=None
+          finally:
+            if res is not None: res.close()
+            res=None
+      return True
+    finally:
+      mirrors.release(acquired)
+
+  try:
+    with futures.ThreadPoolExecutor(max_workers=nseg) as ex:
+      ranges=list(ex.map(_segment, range(nseg)))
+  except:
+    if os.path.exists(part_name): os.remove(part_name)
+    raise
+  finally:
+    _progress.finish(file_name)
+    PROFILER.add_bytes(received[0])
+  if not all(ranges):
+    #  Range is not supported by the mirror
+    os.remove(part_name)
+    res=repo_get(query, stream=True)
+    try:
+      return save_download_file(res, file_name, size, get_chunk_size(size), verbose, h_val)
+    finally:
+      res.close()
+
+  h_val2=get_hash_value(part_name, False)
+  if h_val and h_val.strip() != h_val2:
+    os.remove(part_name)
+    error("MD5 mismatch: %s" % os.path.basename(file_name))
+    return None
+  os.replace(part_name, file_name)
+  get_hash_cache().store(file_name, os.stat(file_name), h_val2)
+  return h_val2
 
 def check_md5_file(h_val, fname):
   res=False
-  if os.path.exists(fname):
+  if h_val and os.path.exists(fname):
     h_val2=get_hash_value(fname).strip()
-    if h_val == h_val2:
+    if h_val.strip() == h_val2:
       res = True
   return res
 #
@@ -117,42 +782,211 @@ def download_package_hash(fname, path):
   try:
     info=get_pkg_info_from_yaml(fname)
     if not info: return None
+    cache=get_pkg_cache(path)
+    #
+    # look up the package cache by MD5
+    ffname=cache.lookup(info['MD5sum'])
+    if ffname and check_md5_file(info['MD5sum'], cache.path_of(ffname)):
+      cache.touch(info['MD5sum'])
+      return ffname
     ffname=os.path.basename(info['filename'])
-    if path:  ffname=path+"\\"+ffname  
-    if check_md5_file(info['MD5sum'], ffname):
-      return os.path.basename(info['filename'])
+    if check_md5_file(info['MD5sum'], cache.path_of(ffname)):
+      cache.add(info['MD5sum'], ffname)
+      return ffname
     return None
   except:
     return None
 
-def download_package_file(fname, path=""):
-  if not os.path.exists(path) : os.makedirs(path)
+@profiled('download')
+def download_package_file(fname, path="", verbose=True):
+  if path : os.makedirs(path, exist_ok=True)
   fname=fname.split(',')[0]
   v=download_package_hash(fname, path)
   if v:
+    event('download', package=fname, file=v, cached=True)
     return v
 
-  file_name=os.path.basename(fname)
-  url="%spkg_download.cgi?name=%s" % (PKG_REPO_BASE, fname)
-  res=requests.get(url, stream=True)
-  if res.status_code == 200:
-    file_name, size = get_attached_filename(res, file_name, path)
-    if check_md5_file(res.headers['Content-MD5sum'], file_name):
+  query="pkg_download.cgi?name=%s" % fname
+  #
+  # resume from the .part file of the previous download
+  part_name=None
+  try:
+    info=get_pkg_info_from_yaml(fname)
+  except:
+    info=None
+  if info:
+    part_name=os.path.basename(info['filename'])+".part"
+    if path: part_name=path+"\\"+part_name
+  offset=0
+  if part_name and os.path.exists(part_name):
+    offset=os.path.getsize(part_name)
+
+  #
+  # downloads are spread over the mirrors, and resumed from the .part file
+  # with the next mirror if the mirror fails or stalls.
+  mirrors=get_mirrors()
+  mirror=acquired=mirrors.acquire()
+  tries=len(mirrors.bases)
+  try:
+    while True:
+      headers={}
+      if offset: headers['Range']="bytes=%d-" % offset
+      res=repo_get(query, prefer=mirror, stream=True, headers=headers)
+      try:
+        if offset and res.status_code == 416:
+          pass
+        elif res.status_code in (200, 206):
+          file_name, size = get_attached_filename(res, os.path.basename(fname), path)
+          if res.status_code == 206:
+            start, size = get_content_range(res)
+          else:
+            start=offset=0    # Range is not supported
+          h_val=res.headers.get('Content-MD5sum')
+          if not h_val and info:
+            h_val=info.get('MD5sum')
+          if check_md5_file(h_val, file_name):
+            event('download', package=fname, file=os.path.basename(file_name), cached=True)
+            return os.path.basename(file_name)
+          if start == offset and (not offset or file_name+".part" == part_name):
+            #
+            # save to file
+            t=time.perf_counter()
+            segmented=(not offset and size >= 2*SEGMENT_MIN_SIZE and SEGMENT_WORKERS > 1 and
+                       res.headers.get('Accept-Ranges') == 'bytes')
+            try:
+              if segmented:
+                h_val=save_segmented_file(res, query, file_name, size, verbose, h_val)
+              else:
+                h_val=save_download_file(res, file_name, size, get_chunk_size(size), verbose, h_val, offset)
+            except requests.RequestException as e:
+              mirrors.failure(res.mirror, e)
+              tries -= 1
+              if tries <= 0: raise
+              part_name=file_name+".part"
+              offset=os.path.getsize(part_name) if os.path.exists(part_name) else 0
+              mirror=None
+              continue
+            if h_val:
+              if not segmented:
+                mirrors.transfer(res.mirror, size-offset, time.perf_counter()-t)
+              get_pkg_cache(path).add(h_val, os.path.basename(file_name))
+              event('download', package=fname, file=os.path.basename(file_name),
+                    size=size, resumed=offset, cached=False, mirror=res.mirror)
+              return os.path.basename(file_name)
+            if not offset:
+              return None
+        else:
+          error("Fail to download: %s" % fname)
+          return None
+      finally:
+        res.close()
+      #
+      # the .part file could not be resumed, download from the beginning
+      if not offset:
+        error("Fail to download: %s" % fname)
+        return None
+      if os.path.exists(part_name): os.remove(part_name)
+      offset=0
+  finally:
+    mirrors.release(acquired)
+
+#
+#  download package list (pkgs.yaml) with conditional GET,
+#  an unchanged list costs only '304 Not Modified'.
+#  if the server gave a catalog revision, only the changes since the
+#  revision are requested, and the full list is fetched if it fails.
+#  the validators are kept for each mirror, and the best mirror is asked.
+@profiled('download')
+def download_catalog(path, verbose=True):
+  os.makedirs(path, exist_ok=True)
+  query="pkg_download.cgi?name=list"
+  mirror=get_mirrors().order()[0]
+  url=mirror+query
+  vfile=path+"\\validators.json"
+  validators=load_http_validators(vfile)
+  v=validators.get(url, {})
+
+  if v.get('filename') and v.get('revision') and os.path.exists(path+"\\"+v['filename']):
+    revision=update_catalog_delta(path+"\\"+v['filename'], v['revision'], mirror)
+    if revision:
+      if revision != v['revision']:
+        #  the local list differs from the full list of the validators
+        validators[url]={ 'filename': v['filename'], 'revision': revision }
+        save_http_validators(vfile, validators)
+      return v['filename']
+
+  headers={}
+  if v.get('filename') and os.path.exists(path+"\\"+v['filename']):
+    if v.get('etag'): headers['If-None-Match']=v['etag']
+    if v.get('last_modified'): headers['If-Modified-Since']=v['last_modified']
+
+  #
+  #  the list is downloaded again from the next mirror if the mirror fails
+  tries=len(get_mirrors().bases)
+  while True:
+    res=repo_get(query, prefer=mirror, stream=True, headers=headers)
+    url=res.mirror+query
+    try:
+      if res.status_code == 304:
+        return v['filename']
+      if res.status_code != 200:
+        error("Fail to download: list")
+        return None
+      file_name, size = get_attached_filename(res, "pkgs.yaml", path)
+      h_val=res.headers.get('Content-MD5sum')
+      if not check_md5_file(h_val, file_name):
+        try:
+          if not save_download_file(res, file_name, size, get_chunk_size(size), verbose, h_val):
+            return None
+        except requests.RequestException as e:
+          get_mirrors().failure(res.mirror, e)
+          tries -= 1
+          if tries <= 0: raise
+          mirror=None
+          continue
+        event('catalog', file=os.path.basename(file_name), size=size)
+      validators[url]={ 'filename': os.path.basename(file_name),
+                        'etag': res.headers.get('ETag'),
+                        'last_modified': res.headers.get('Last-Modified'),
+                        'revision': res.headers.get('X-Catalog-Revision') }
+      save_http_validators(vfile, validators)
       return os.path.basename(file_name)
-    #
-    # save to file
-    dl_chunk_size=1024
-    save_download_file(res, file_name, size, dl_chunk_size)
-    print("")
-    return os.path.basename(file_name)
-  else:
-    print("Fail to download: %s" % fname)
+    finally:
+      res.close()
+#
+#  changes of the catalog since the revision (pkg_delta.cgi):
+#    {"revision": rev, "changed": [entry, ...], "removed": [package, ...], "count": n}
+#  they are merged into the local list. returns the new revision, or None
+#  if the delta is not available (e.g. the revision is too old, or of
+#  another mirror).
+def update_catalog_delta(fname, revision, mirror=None):
+  try:
+    res=repo_get("pkg_delta.cgi?since=%s" % revision, prefer=mirror)
+  except requests.RequestException:
     return None
+  if res.status_code == 304:
+    return revision
+  if res.status_code != 200:
+    return None
+  try:
+    delta=res.json()
+    changed=delta.get('changed') or []
+    removed=delta.get('removed') or []
+    entries=merge_catalog(get_catalog(fname).entries, changed, removed)
+  except (ValueError, KeyError, TypeError, AttributeError):
+    return None
+  if delta.get('count') is not None and len(entries) != delta['count']:
+    return None
+  save_catalog(fname, entries)
+  event('catalog', file=os.path.basename(fname), revision=delta.get('revision'),
+        changed=len(changed), removed=len(removed))
+  return delta.get('revision') or revision
+
 #
 #
+@profiled('network')
 def get_pkg_dep(name, typ='json'):
-    url="%spkg_dep.cgi?name=%s&type=%s" % (PKG_REPO_BASE, name, typ)
-    res=requests.get(url)
+    res=repo_get("pkg_dep.cgi?name=%s&type=%s" % (name, typ))
     if res.status_code == 200:
         lst=res.text
         return lst
@@ -160,8 +994,7 @@ def get_pkg_dep(name, typ='json'):
 #
 #
 def get_pkg_list(pname):
-    url="%spkg_list.cgi?name=%s" % (PKG_REPO_BASE, pname)
-    res=requests.get(url)
+    res=repo_get("pkg_list.cgi?name=%s" % pname)
     if res.status_code == 200:
         lst=eval(res.text)
         return lst
@@ -169,8 +1002,7 @@ def get_pkg_list(pname):
 #
 #
 def get_pkgs_yaml(pname):
-  url="%sget_pkg_dep.cgi?name=%s" % (PKG_REPO_BASE, pname)
-  res=requests.get(url)
+  res=repo_get("get_pkg_dep.cgi?name=%s" % pname)
   if res.status_code == 200:
     lst=res.text.split()
     return lst
@@ -187,12 +1019,100 @@ def exist_meta_pkg(names):
     if is_meta_pkg(n) : return True
   return False
 
-def get_hash_value(fname):
+@profiled('hash')
+def get_hash_value(fname, use_cache=True):
   if os.path.exists(fname):
-    return hashlib.md5(open(fname, 'rb').read()).hexdigest()
+    st=os.stat(fname)
+    if use_cache:
+      h_val=get_hash_cache().lookup(fname, st)
+      if h_val : return h_val
+    md5=hashlib.md5()
+    with open(fname, 'rb') as f:
+      for chunk in iter(lambda: f.read(HASH_BUF_SIZE), b''):
+        md5.update(chunk)
+    PROFILER.add_bytes(st.st_size)
+    h_val=md5.hexdigest()
+    if use_cache:
+      get_hash_cache().store(fname, st, h_val)
+    return h_val
   else:
     return None
 
+#
+#  persistent cache of file hashes, keyed by path, size, mtime and inode.
+#  an entry is used only if all of them are equal to the current stat.
+class HashCache:
+  def __init__(self, dbname):
+    self.dbname=dbname
+    self.conn=None
+    self.disabled=False
+    self.lock=threading.Lock()
+
+  #
+  #  the cache is disabled when the database can not be opened (e.g. RPT dir is not writable)
+  def open(self):
+    if self.disabled:
+      raise sqlite3.OperationalError("hash cache is disabled")
+    if self.conn is None:
+      conn=None
+      try:
+        os.makedirs(os.path.dirname(self.dbname), exist_ok=True)
+        conn=sqlite3.connect(self.dbname, timeout=10, check_same_thread=False)
+        conn.execute("pragma synchronous=NORMAL")
+        conn.execute("create table if not exists file_hash (path text primary key, size integer, mtime integer, inode integer, h_val text)")
+        conn.commit()
+      except (OSError, sqlite3.Error):
+        if conn: conn.close()
+        self.disabled=True
+        raise sqlite3.OperationalError("hash cache is disabled")
+      self.conn=conn
+    return self.conn
+
+  def key(self, fname):
+    return os.path.normcase(os.path.abspath(fname))
+
+  def lookup(self, fname, st):
+    try:
+      with self.lock:
+        res=self.open().execute("select size, mtime, inode, h_val from file_hash where path=?",
+                                (self.key(fname),)).fetchone()
+    except (OSError, sqlite3.Error):
+      return None
+    if res and tuple(res[:3]) == (st.st_size, st.st_mtime_ns, st.st_ino):
+      return res[3]
+    return None
+
+  def store(self, fname, st, h_val):
+    try:
+      #  the file was changed while hashing
+      if os.stat(fname).st_mtime_ns != st.st_mtime_ns: return
+      with self.lock:
+        conn=self.open()
+        conn.execute("insert or replace into file_hash (path, size, mtime, inode, h_val) values (?,?,?,?,?)",
+                     (self.key(fname), st.st_size, st.st_mtime_ns, st.st_ino, h_val))
+        conn.commit()
+    except (OSError, sqlite3.Error):
+      pass
+
+  def remove(self, fname):
+    try:
+      with self.lock:
+        conn=self.open()
+        conn.execute("delete from file_hash where path=?", (self.key(fname),))
+        conn.commit()
+    except (OSError, sqlite3.Error):
+      pass
+
+_hash_cache=None
+_hash_cache_lock=threading.Lock()
+
+def get_hash_cache():
+  global _hash_cache
+  with _hash_cache_lock:
+    if _hash_cache is None:
+      _hash_cache=HashCache(getRptDir()+"\\__pkg__\\"+HASH_CACHE_DB)
+    return _hash_cache
+
 def get_pkg_name(fname):
   name=os.path.basename(fname)
   if PKG_PREFIX in name:
@@ -215,30 +1135,81 @@ def default_pkgmgr_db(drv=None):
   return "%s%s/%s" % (drv, PKG_MGR_DIR, PKG_DB)
 
 #
-def remove_pkg_file_all(pkg, drv):
+#  remove installed files of the package. files which are also installed
+#  by other packages are kept, and empty directories are removed bottom-up.
+def remove_pkg_file_all(pkg, drv, workers=None):
+  if workers is None: workers=INSTALL_WORKERS
   dbname=default_pkgmgr_db(drv)
   files=select_install_info(pkg, dbname)
 
+  removed=[]
   if files:
-    sfiles=sorted(files, key=len, reverse=True)
-    cnt=0
-    for f in sfiles:
-      fname="%s%s" % (drv, f)
-      if os.path.exists(fname):
-        if os.path.isfile(fname):
-          os.remove(fname)
-        else:
-          try:
-            os.removedirs(fname)
-          except:
-            pass
-      print("\rRemoving %s  " % getMonDots(cnt), end="", flush=True)
-      cnt += 1
+    refs=count_path_refs(pkg, dbname)
+    removed=[drv+f for f in set(files) if not f in refs]
+    remove_paths(removed, drv, workers)
     delete_install_info(pkg, dbname)
     delete_pkg_data(pkg, dbname)
-  print()
+  event('remove', package=pkg, files=len(removed), kept=len(files or [])-len(removed))
   return
 
+#
+#  remove files in batches, and then empty directories
+@profiled('remove')
+def remove_paths(paths, drv, workers=None):
+  if workers is None: workers=INSTALL_WORKERS
+  dirs=set()
+  #  parent directories, except the top directories (e.g. \opt, \local)
+  top=path_depth(drv)+1
+  for f in paths:
+    parent=os.path.dirname(f)
+    while path_depth(parent) > top and not parent in dirs:
+      dirs.add(parent)
+      parent=os.path.dirname(parent)
+
+  batches=[paths[i:i+REMOVE_BATCH_SIZE] for i in range(0, len(paths), REMOVE_BATCH_SIZE)]
+  cnt=0
+  if workers > 1 and len(batches) > 1:
+    with futures.ThreadPoolExecutor(max_workers=workers) as ex:
+      for res in ex.map(remove_files, batches):
+        dirs.update(res)
+        cnt += 1
+        _progress.update('remove', cnt, len(batches), "Removing")
+  else:
+    for batch in batches:
+      dirs.update(remove_files(batch))
+      cnt += 1
+      _progress.update('remove', cnt, len(batches), "Removing")
+  remove_empty_dirs(dirs)
+  _progress.finish('remove')
+
+#
+#
+def path_depth(path):
+  return len([x for x in re.split(r'[\\/]', path) if x])
+
+#
+#  remove files, returns directories found in the list
+def remove_files(paths):
+  dirs=[]
+  for f in paths:
+    try:
+      if stat.S_ISDIR(os.lstat(f).st_mode):
+        dirs.append(f)
+      else:
+        os.remove(f)
+    except OSError:
+      pass
+  return dirs
+
+#
+#  remove empty directories, the deepest first
+def remove_empty_dirs(dirs):
+  for d in sorted(dirs, key=lambda x: len(os.path.normpath(x)), reverse=True):
+    try:
+      os.rmdir(d)
+    except OSError:
+      pass
+
 #
 #
 def get_installed_pkgs(drv):
@@ -247,6 +1218,162 @@ def get_installed_pkgs(drv):
     print("No database:", dbname)
   return select_install_info_name(dbname)
   
+####
+# Package cache
+#
+def parse_size(val):
+  val=str(val).strip().upper()
+  units={'K': 1024, 'M': 1024**2, 'G': 1024**3, 'T': 1024**4}
+  if val and val[-1] in units:
+    return int(float(val[:-1]) * units[val[-1]])
+  return int(val)
+
+#
+#  downloaded package files indexed by MD5, with the last used time.
+#  files stay under their names in the directory, packages which are
+#  installed are pinned and the others are evicted in LRU order.
+class PkgCache:
+  def __init__(self, path):
+    self.path=path
+    self.dbname=self.path_of(PKG_CACHE_DB)
+    self.conn=None
+    self.lock=threading.Lock()
+
+  def path_of(self, fname):
+    if self.path: return self.path+"\\"+fname
+    return fname
+
+  def open(self):
+    if self.conn is None:
+      if self.path: os.makedirs(self.path, exist_ok=True)
+      self.conn=sqlite3.connect(self.dbname, timeout=10, check_same_thread=False)
+      self.conn.execute("pragma synchronous=NORMAL")
+      self.conn.execute("create table if not exists pkg_cache (h_val text primary key, fname text, size integer, last_used real)")
+      self.conn.commit()
+    return self.conn
+
+  def execute(self, sql, params=()):
+    with self.lock:
+      conn=self.open()
+      res=conn.execute(sql, params).fetchall()
+      conn.commit()
+    return res
+
+  def lookup(self, h_val):
+    res=self.execute("select fname from pkg_cache where h_val=?", (h_val,))
+    if res: return res[0][0]
+    return None
+
+  #
+  #  a new version may be saved to the same file name, the entries of
+  #  the old contents are dropped
+  def add(self, h_val, fname, last_used=None):
+    if last_used is None: last_used=time.time()
+    try:
+      size=os.path.getsize(self.path_of(fname))
+      with self.lock:
+        conn=self.open()
+        conn.execute("delete from pkg_cache where fname=? and h_val<>?", (fname, h_val))
+        conn.execute("insert or replace into pkg_cache (h_val, fname, size, last_used) values (?,?,?,?)",
+                     (h_val, fname, size, last_used))
+        conn.commit()
+    except (OSError, sqlite3.Error):
+      pass
+
+  def touch(self, h_val):
+    try:
+      self.execute("update pkg_cache set last_used=? where h_val=?", (time.time(), h_val))
+    except sqlite3.Error:
+      pass
+
+  def entries(self):
+    return self.execute("select h_val, fname, size, last_used from pkg_cache order by last_used")
+
+  #
+  #  index package files which are not in the cache yet, drop entries
+  #  whose files have been removed, and re-index files which have been
+  #  changed (the size differs, or more than one entry)
+  def scan(self):
+    known={}
+    for x in self.entries():
+      known.setdefault(x[1], []).append(x)
+    for fname, ents in known.items():
+      f=self.path_of(fname)
+      try:
+        size=os.path.getsize(f)
+      except OSError:
+        self.execute("delete from pkg_cache where fname=?", (fname,))
+        continue
+      if len(ents) > 1 or ents[0][2] != size:
+        self.add(get_hash_value(f), fname, max([x[3] for x in ents]))
+    for f in glob.glob(self.path_of("*"+PKG_EXT)):
+      fname=os.path.basename(f)
+      if not fname in known:
+        self.add(get_hash_value(f), fname, os.path.getmtime(f))
+
+  def stats(self, pinned=()):
+    self.scan()
+    ents=self.entries()
+    res={ 'count': len(ents),
+          'size': sum([x[2] for x in ents]),
+          'max_size': parse_size(PKG_CACHE_SIZE),
+          'pinned': len([x for x in ents if x[0] in pinned]),
+          'pinned_size': sum([x[2] for x in ents if x[0] in pinned]) }
+    if ents:
+      res['oldest']=datetime.datetime.fromtimestamp(ents[0][3]).strftime("%Y-%m-%d %H:%M")
+      res['newest']=datetime.datetime.fromtimestamp(ents[-1][3]).strftime("%Y-%m-%d %H:%M")
+    return res
+
+  #
+  #  remove the least recently used files until the cache fits max_size.
+  #  returns the list of removed files
+  def prune(self, pinned=(), max_size=None):
+    if max_size is None: max_size=parse_size(PKG_CACHE_SIZE)
+    self.scan()
+    ents=self.entries()
+    total=sum([x[2] for x in ents])
+    removed=[]
+    for h_val, fname, size, last_used in ents:
+      if total <= max_size: break
+      if h_val in pinned: continue
+      #  the file has other contents (e.g. pinned) than the entry
+      if get_hash_value(self.path_of(fname)) != h_val:
+        self.execute("delete from pkg_cache where h_val=?", (h_val,))
+        total -= size
+        continue
+      try:
+        os.remove(self.path_of(fname))
+      except OSError:
+        if os.path.exists(self.path_of(fname)): continue
+      get_hash_cache().remove(self.path_of(fname))
+      self.execute("delete from pkg_cache where h_val=?", (h_val,))
+      total -= size
+      removed.append(fname)
+    return removed
+
+_pkg_caches={}
+_pkg_caches_lock=threading.Lock()
+
+def get_pkg_cache(path=None):
+  if path is None: path=getRptDir()+"\\ros_pkg"
+  key=os.path.abspath(path or ".")
+  with _pkg_caches_lock:
+    if not key in _pkg_caches:
+      _pkg_caches[key]=PkgCache(path)
+    return _pkg_caches[key]
+
+#
+#  hash values of the installed package files (pinned in the cache)
+def get_installed_hashes(drv):
+  dbname=default_pkgmgr_db(drv)
+  try:
+    return set([x[4] for x in select_pkg_data('all', dbname) if x[4]])
+  except:
+    return set()
+
+def prune_pkg_cache(drv, path=None, max_size=None):
+  return get_pkg_cache(path).prune(get_installed_hashes(drv), max_size)
+
 ####
 # Download packages
 #
@@ -254,6 +1381,154 @@ def get_pkgs(names, path=""):
   for f in names:
     download_package_file(f, path)
 
+#
+#  download packages with a bounded thread pool,
+#  callback(name, count, total) is called when each package is finished.
+#  returns list of filenames (in order of names) and {name: error}
+def download_package_files(names, path="", workers=None, callback=None):
+  if workers is None: workers=DL_WORKERS
+  if path : os.makedirs(path, exist_ok=True)
+  files={}
+  errors={}
+  n=len(names)
+  lock=threading.Lock()
+
+  def _download(x):
+    try:
+      fname=download_package_file(x, path, workers <= 1)
+      err=None if fname else "Fail to download"
+    except Exception as e:
+      fname=None
+      err=str(e) or e.__class__.__name__
+    with lock:
+      if fname: files[x]=fname
+      else: errors[x]=err
+      if callback: callback(x, len(files)+len(errors), n)
+
+  if workers <= 1:
+    for x in names:
+      _download(x)
+  else:
+    with futures.ThreadPoolExecutor(max_workers=workers) as ex:
+      for fut in futures.as_completed([ex.submit(_download, x) for x in names]):
+        fut.result()
+  return [files[x] for x in names if x in files], errors
+
+#######
+# Bundle
+#
+#  a bundle is a tar file to install packages without the network:
+#     manifest.json   package, MD5sum, size and run_dep/lib_dep of the files
+#     pkgs.yaml       catalog entries of the packages (JSON)
+#     packages/       package files
+#  the manifest is the first member, and the bundle is read as a stream.
+BUNDLE_FORMAT=1
+BUNDLE_MANIFEST="manifest.json"
+BUNDLE_CATALOG="pkgs.yaml"
+BUNDLE_PKG_DIR="packages/"
+
+def add_bundle_data(tar, name, data):
+  info=tarfile.TarInfo(name)
+  info.size=len(data)
+  info.mtime=int(time.time())
+  info.mode=0o644
+  tar.addfile(info, io.BytesIO(data))
+
+#
+#  write the package files (already downloaded) to the bundle,
+#  the hashes are taken from the hash cache. returns the manifest
+@profiled('bundle')
+def export_bundle(name, files, fname):
+  cat=get_catalog()
+  names=[]
+  entries=[]
+  for f in files:
+    x=cat.files.get(os.path.basename(f))
+    if x: entries.append(x)
+    names.append(x['package'] if x else os.path.basename(f).replace(PKG_EXT, ""))
+  prefetch_pkg_deps(names)
+  packages=[]
+  for f, pkgname in zip(files, names):
+    run_dep, lib_dep=lookup_pkg_dep(pkgname)
+    packages.append({ 'package': pkgname, 'file': os.path.basename(f),
+                      'MD5sum': get_hash_value(f), 'size': os.path.getsize(f),
+                      'run_dep': run_dep, 'lib_dep': lib_dep })
+  manifest={ 'format': BUNDLE_FORMAT, 'package': name,
+             'created': time.strftime("%Y-%m-%d %H:%M:%S"),
+             'packages': packages }
+  catalog="[\n" + ",\n".join([json.dumps(x, default=str) for x in entries]) + "\n]\n"
+
+  part_name=fname+".part"
+  with tarfile.open(part_name, 'w') as tar:
+    add_bundle_data(tar, BUNDLE_MANIFEST, json.dumps(manifest, indent=1).encode())
+    add_bundle_data(tar, BUNDLE_CATALOG, catalog.encode())
+    for f in files:
+      tar.add(f, BUNDLE_PKG_DIR+os.path.basename(f))
+      PROFILER.add_bytes(os.path.getsize(f))
+  os.replace(part_name, fname)
+  event('bundle', package=name, file=fname, packages=len(packages),
+        size=os.path.getsize(fname))
+  return manifest
+
+#
+#  extract the package files of the bundle to the package cache (path),
+#  and merge the catalog entries into the local catalog. the files are
+#  checked with the manifest while they are copied, and the hash cache is
+#  seeded so that they are not hashed again to be installed.
+#  returns the manifest and the extracted files (in order of the manifest)
+@profiled('bundle')
+def import_bundle(fname, path=None):
+  if path is None: path=getRptDir()+"\\ros_pkg"
+  os.makedirs(path, exist_ok=True)
+  cache=get_pkg_cache(path)
+  manifest=None
+  hashes={}
+  entries=[]
+  files={}
+  with tarfile.open(fname, 'r|') as tar:
+    for member in tar:
+      if member.name == BUNDLE_MANIFEST:
+        manifest=json.loads(tar.extractfile(member).read().decode('utf-8'))
+        if manifest.get('format') != BUNDLE_FORMAT:
+          raise ValueError("Unsupported bundle format: %s" % manifest.get('format'))
+        hashes=dict([(x['file'], x['MD5sum']) for x in manifest['packages']])
+      elif member.name == BUNDLE_CATALOG:
+        entries=parse_catalog(tar.extractfile(member).read())
+      elif member.name.startswith(BUNDLE_PKG_DIR) and member.isreg():
+        base=os.path.basename(member.name)
+        if manifest is None or not base in hashes:
+          error("Not in the manifest:", base)
+          continue
+        target=path+"\\"+base
+        if not check_md5_file(hashes[base], target):
+          h_val=copy_with_hash(tar.extractfile(member), target+".part")
+          PROFILER.add_bytes(member.size)
+          if h_val != hashes[base]:
+            os.remove(target+".part")
+            error("MD5 mismatch: %s" % base)
+            continue
+          os.replace(target+".part", target)
+          get_hash_cache().store(target, os.stat(target), h_val)
+        cache.add(hashes[base], base)
+        files[base]=target
+  if manifest is None:
+    raise ValueError("No manifest in the bundle: %s" % fname)
+
+  #
+  #  the validators are removed, the next update gets the full list again
+  catalog=default_catalog_path()
+  os.makedirs(os.path.dirname(catalog), exist_ok=True)
+  if os.path.exists(catalog):
+    entries=merge_catalog(get_catalog(catalog).entries, entries, [])
+  save_catalog(catalog, entries)
+  vfile=os.path.dirname(catalog)+"\\validators.json"
+  if os.path.exists(vfile): os.remove(vfile)
+  with _pkg_deps_lock:
+    for x in manifest['packages']:
+      _pkg_deps[x['package']]=(x['run_dep'], x['lib_dep'])
+  event('bundle', package=manifest['package'], file=fname, packages=len(files))
+  return manifest, [files[x['file']] for x in manifest['packages'] if x['file'] in files]
+
 #####
 # Database
 #
@@ -263,6 +1538,57 @@ def get_dbname(to_dir, db):
   dbname = d+PKG_MGR_DIR+"/"+db
   return dbname
 
+#
+#  schema of the package database
+PKG_DB_TABLES={
+  'packages' : 'name text, fname text, run_dep text, lib_dep text, h_val text, uptime timestamp',
+  'install_info' : 'name text, path text, uptime timestamp, size integer, h_val text',
+  'pkg_alias' : 'alias text, name text, unique(alias, name)',
+}
+PKG_DB_VERSION=3
+_db_initialized=set()
+_db_init_lock=threading.Lock()
+
+#
+#  open the package database, tables are created at the first open.
+def open_pkg_db(dbname=None):
+  if dbname is None: dbname=default_pkgmgr_db()
+  conn=sqlite3.connect(dbname, timeout=30)
+  conn.execute("pragma synchronous=NORMAL")
+  key=os.path.abspath(dbname)
+  with _db_init_lock:
+    if not key in _db_initialized:
+      conn.execute("pragma journal_mode=WAL")
+      for name in PKG_DB_TABLES:
+        conn.execute("create table if not exists %s (%s)" % (name, PKG_DB_TABLES[name]))
+      migrate_pkg_db(conn)
+      conn.commit()
+      _db_initialized.add(key)
+  return conn
+
+#
+#  upgrade the database created by older versions (pragma user_version)
+def migrate_pkg_db(conn):
+  ver=conn.execute("pragma user_version").fetchone()[0]
+  if ver < 1:
+    #  package names (aliases) of the comma-joined names, and indexes
+    conn.execute("create index if not exists packages_name on packages(name)")
+    conn.execute("create index if not exists install_info_name on install_info(name)")
+    for x in conn.execute("select name from packages union select name from install_info").fetchall():
+      insert_pkg_alias(x[0], conn)
+  if ver < 2:
+    #  reference count of the installed files
+    conn.execute("create index if not exists install_info_path on install_info(path)")
+  if ver < 3:
+    #  size and hash of the installed files
+    cols=[x[1] for x in conn.execute("pragma table_info(install_info)").fetchall()]
+    if not 'size' in cols:
+      conn.execute("alter table install_info add column size integer")
+    if not 'h_val' in cols:
+      conn.execute("alter table install_info add column h_val text")
+  if ver < PKG_DB_VERSION:
+    conn.execute("pragma user_version=%d" % PKG_DB_VERSION)
+
 #
 #  create table
 def create_db_table(name, schema, dbname=PKG_DB):
@@ -277,15 +1603,19 @@ def create_db_table(name, schema, dbname=PKG_DB):
     conn.close()
 
 #
-# exec SQL
-def exec_sql(sql, dbname=PKG_DB):
-  res=[]
-  with closing(sqlite3.connect(dbname)) as conn:
-    c = conn.cursor()
-    res=c.execute(sql).fetchall()
-    conn.commit()
-    conn.close()
-  return res
+# exec SQL (query), the database is not created nor changed. a database
+# of an older version is migrated if the query fails.
+def exec_sql(sql, dbname=PKG_DB, params=()):
+  if not os.path.exists(dbname):
+    raise sqlite3.OperationalError("unable to open database file: %s" % dbname)
+  with closing(sqlite3.connect(dbname, timeout=30)) as conn:
+    try:
+      return conn.execute(sql, params).fetchall()
+    except sqlite3.OperationalError:
+      if conn.execute("pragma user_version").fetchone()[0] >= PKG_DB_VERSION:
+        raise
+  with closing(open_pkg_db(dbname)) as conn:
+    return conn.execute(sql, params).fetchall()
 
 #
 #
@@ -300,71 +1630,123 @@ def list_except(x, y, delim=":"):
 
 #
 #
+#  returns the condition and its parameters
 def pkgname_matching_pattern(name, exact=False):
   if exact :
-    res="name='%s'" % name
-  else:
-    res="name='%s' or name glob '%s,*' or name glob '*,%s' or name glob '*,%s,*'" % (name, name, name, name)
-  return res
+    return "name=?", (name,)
+  return "name=? or name in (select name from pkg_alias where alias=?)", (name, name)
+
+#
+#  each name of the comma-joined package name
+def insert_pkg_alias(name, conn):
+  conn.executemany("insert or ignore into pkg_alias (alias, name) values (?,?)",
+                   [(x, name) for x in name.split(',')])
+
+def delete_unused_pkg_alias(conn):
+  conn.execute("delete from pkg_alias where name not in (select name from packages) and name not in (select name from install_info)")
 
 ######################
 #  for table 'package'
 #
-def insert_pkg_data(name, fname, h_val=None, dbname=None):
-  if dbname is None: dbname=default_pkgmgr_db()
-  create_db_table('packages', 'name text, fname text, run_dep text, lib_dep text, h_val text, uptime timestamp', dbname)
+def insert_pkg_data(name, fname, h_val=None, dbname=None, conn=None):
+  if conn is None:
+    with closing(open_pkg_db(dbname)) as conn:
+      insert_pkg_data(name, fname, h_val, dbname, conn)
+      conn.commit()
+    return
 
-  with closing(sqlite3.connect(dbname)) as conn:
-    c = conn.cursor()
-    sql="delete from packages where name='%s'" % name
-    c.execute(sql)
-    conn.commit()
+  c = conn.cursor()
+  c.execute("delete from packages where name=?", (name,))
+  insert_pkg_alias(name, conn)
 
-    sql = "insert into packages (name, fname, h_val,run_dep,lib_dep,uptime) values (?,?,?,?,?,?)"
+  sql = "insert into packages (name, fname, h_val,run_dep,lib_dep,uptime) values (?,?,?,?,?,?)"
+  if os.path.exists(fname):
     ftime = datetime.datetime.fromtimestamp(os.stat(fname).st_mtime)
-    res=get_pkg_dep(name).split("\n")
     h_val=get_hash_value(fname)
+  else:
+    ftime = datetime.datetime.now()
+  run_dep, lib_dep=lookup_pkg_dep(name)
 
-    data=(name, os.path.basename(fname), h_val, res[0], res[1], ftime)
-    c.execute(sql, data)
-    conn.commit()
+  data=(name, os.path.basename(fname), h_val, run_dep, lib_dep, ftime)
+  c.execute(sql, data)
 
-    conn.close()
+#
+#  run_dep and lib_dep of the package. they are taken from the catalog,
+#  'depend' of the entry is split into packages in the catalog and the
+#  others (libraries). no network access, see prefetch_pkg_deps.
+_pkg_deps={}
+_pkg_deps_lock=threading.Lock()
+
+def catalog_pkg_dep(name, path=None):
+  try:
+    cat=get_catalog(path)
+  except (OSError, ValueError):
+    return None
+  x=cat.packages.get(name) or cat.names.get(name.split(',')[0])
+  if x is None or x.get('depend') is None:
+    return None
+  deps=x['depend']
+  return (":".join([d for d in deps if d in cat.names]),
+          ":".join([d for d in deps if not d in cat.names]))
+
+def lookup_pkg_dep(name):
+  res=catalog_pkg_dep(name)
+  if res is None:
+    with _pkg_deps_lock:
+      res=_pkg_deps.get(name)
+  return res or ("", "")
+
+#
+#  fetch run_dep/lib_dep of packages which are not in the catalog in
+#  one batch (pkg_dep.cgi), before the package database is opened.
+def prefetch_pkg_deps(names, workers=None):
+  if workers is None: workers=DL_WORKERS
+  with _pkg_deps_lock:
+    names=[x for x in set(names) if x and not x in _pkg_deps and catalog_pkg_dep(x) is None]
+  if not names: return
+
+  def _fetch(name):
+    try:
+      res=get_pkg_dep(name.split(',')[0])
+    except requests.RequestException:
+      res=None
+    if res is None: return name, None
+    res=(res+"\n").split("\n")
+    return name, (res[0].strip(), res[1].strip())
+
+  with futures.ThreadPoolExecutor(max_workers=max(min(workers, len(names)), 1)) as ex:
+    for name, res in ex.map(_fetch, names):
+      if res is not None:
+        with _pkg_deps_lock:
+          _pkg_deps[name]=res
 #
 #
 def select_pkg_data(name, dbname=None):
   res=[]
   if dbname is None: dbname=default_pkgmgr_db()
-  with closing(sqlite3.connect(dbname)) as conn:
-    c = conn.cursor()
-    if name == 'all':
-      sql = "select * from packages"
-    else:
-      sql = "select * from packages where %s" % pkgname_matching_pattern(name)
-    res=c.execute(sql).fetchall()
-    conn.commit()
-    conn.close()
-  return res
+  if name == 'all':
+    return exec_sql("select * from packages", dbname)
+  cond, params=pkgname_matching_pattern(name)
+  return exec_sql("select * from packages where %s" % cond, dbname, params)
 
 #
 #
 def get_hash_valeu_from_db(name, dbname=None):
   res=[]
   if dbname is None: dbname=default_pkgmgr_db()
-  with closing(sqlite3.connect(dbname)) as conn:
-    c = conn.cursor()
-    sql = "select h_val from packages where %s" % pkgname_matching_pattern(name)
-    res=c.execute(sql).fetchall()
-    conn.commit()
-    conn.close()
+  cond, params=pkgname_matching_pattern(name)
+  res=exec_sql("select h_val from packages where %s" % cond, dbname, params)
   return res[0]
 #
 #
 def delete_pkg_data(name, dbname=None):
   if dbname is None: dbname=default_pkgmgr_db()
-  sql="delete from packages where %s" % pkgname_matching_pattern(name)
+  cond, params=pkgname_matching_pattern(name)
   try:
-    res=exec_sql(sql, dbname)
+    with closing(open_pkg_db(dbname)) as conn:
+      conn.execute("delete from packages where %s" % cond, params)
+      delete_unused_pkg_alias(conn)
+      conn.commit()
     return True
   except:
     return False
@@ -373,36 +1755,130 @@ def delete_pkg_data(name, dbname=None):
 #  for table 'install_info'
 #
 def insert_install_info(pkgname, fname, dbname=None):
-  if dbname is None: dbname=default_pkgmgr_db()
-  create_db_table('install_info', "name text, path text, uptime timestamp", dbname)
+  insert_install_info_list(pkgname, [fname], dbname)
 
-  with closing(sqlite3.connect(dbname)) as conn:
-    c = conn.cursor()
-    sql = "insert into install_info (name, path, uptime) values (?,?,?)"
-    ftime = datetime.datetime.now()
-    data=(pkgname, fname, ftime)
-    c.execute(sql, data)
+#
+#  insert installed files of the package in one transaction,
+#  each file is a path or a tuple of (path, size, hash)
+@profiled('sqlite')
+def insert_install_info_list(pkgname, files, dbname=None, conn=None):
+  if conn is None:
+    with closing(open_pkg_db(dbname)) as conn:
+      insert_install_info_list(pkgname, files, dbname, conn)
+      conn.commit()
+    return
+
+  sql = "insert into install_info (name, path, uptime, size, h_val) values (?,?,?,?,?)"
+  ftime = datetime.datetime.now()
+  rows=[]
+  for f in files:
+    if isinstance(f, tuple):
+      rows.append((pkgname, f[0], ftime, f[1], f[2]))
+    else:
+      rows.append((pkgname, f, ftime, None, None))
+  conn.executemany(sql, rows)
+  insert_pkg_alias(pkgname, conn)
+
+#
+#  record the package and its installed files in one transaction
+@profiled('sqlite')
+def insert_install_record(pkgname, fname, files, dbname=None, h_val=None, conn=None):
+  if conn is None:
+    with closing(open_pkg_db(dbname)) as conn:
+      insert_install_record(pkgname, fname, files, dbname, h_val, conn)
+    return
+  try:
+    insert_pkg_data(pkgname, fname, h_val, dbname, conn)
+    insert_install_info_list(pkgname, files, dbname, conn)
     conn.commit()
-    conn.close()
+  except:
+    conn.rollback()
+    raise
+
+#
+#  single writer thread of the package database for parallel installation,
+#  records are queued by workers and written through one connection per db.
+class DBWriter:
+  def __init__(self):
+    self.queue=queue.Queue()
+    self.thread=threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def record(self, pkgname, fname, files, dbname, h_val=None):
+    self.queue.put((pkgname, fname, files, dbname, h_val))
+
+  def run(self):
+    conns={}
+    while True:
+      item=self.queue.get()
+      if item is None: break
+      pkgname, fname, files, dbname, h_val=item
+      try:
+        if not dbname in conns:
+          conns[dbname]=open_pkg_db(dbname)
+        insert_install_record(pkgname, fname, files, dbname, h_val, conns[dbname])
+      except:
+        error(fname, ": Fail to record installed files...")
+    for conn in conns.values():
+      conn.close()
 
+  def close(self):
+    self.queue.put(None)
+    self.thread.join()
 #
 #
 def select_install_info(name, dbname=None):
   if dbname is None: dbname=default_pkgmgr_db()
-  sql="select * from install_info where %s;" % pkgname_matching_pattern(name)
+  cond, params=pkgname_matching_pattern(name)
+  sql="select * from install_info where %s;" % cond
   try:
-    res=exec_sql(sql, dbname)
+    res=exec_sql(sql, dbname, params)
     return [x[1] for x in res]
   except:
     return []
 
+#
+#  installed files of the package, {path: (size, hash)}
+def select_install_manifest(name, dbname=None):
+  if dbname is None: dbname=default_pkgmgr_db()
+  cond, params=pkgname_matching_pattern(name)
+  sql="select path, size, h_val from install_info where %s;" % cond
+  try:
+    return dict([(x[0], (x[1], x[2])) for x in exec_sql(sql, dbname, params)])
+  except:
+    return {}
+
+#
+#  installed files of the package (or 'all'): [(name, path, size, hash)]
+def select_install_files(name, dbname=None):
+  if dbname is None: dbname=default_pkgmgr_db()
+  if name == 'all':
+    return exec_sql("select name, path, size, h_val from install_info", dbname)
+  cond, params=pkgname_matching_pattern(name)
+  return exec_sql("select name, path, size, h_val from install_info where %s" % cond, dbname, params)
+
+#
+#
+def count_path_refs(name, dbname=None):
+  if dbname is None: dbname=default_pkgmgr_db()
+  #  number of other packages which have installed the same path
+  cond, params=pkgname_matching_pattern(name)
+  sql="select path, count(distinct name) from install_info where path in (select path from install_info where %s) and not (%s) group by path;" % (cond, cond)
+  try:
+    return dict(exec_sql(sql, dbname, params+params))
+  except:
+    return {}
+
 #
 #
 def delete_install_info(name, dbname=None):
   if dbname is None: dbname=default_pkgmgr_db()
-  sql="delete from install_info where %s;" % pkgname_matching_pattern(name)
+  cond, params=pkgname_matching_pattern(name)
   try:
-    res=exec_sql(sql, dbname)
+    with closing(open_pkg_db(dbname)) as conn:
+      conn.execute("delete from install_info where %s;" % cond, params)
+      delete_unused_pkg_alias(conn)
+      conn.commit()
     return True
   except:
     return False
@@ -420,44 +1896,166 @@ def select_install_info_name(dbname=None):
 ########################
 # untar package file
 # 
-def untar(fname, to_dir, num=10, db=None):
+#  file object which counts and hashes the bytes read from 'fileobj'
+class HashReader:
+  def __init__(self, fileobj):
+    self.fileobj=fileobj
+    self.md5=hashlib.md5()
+    self.count=0
+
+  def read(self, size=-1):
+    data=self.fileobj.read(size)
+    self.md5.update(data)
+    self.count += len(data)
+    return data
+
+  def tell(self):
+    return self.count
+
+  def hexdigest(self):
+    return self.md5.hexdigest()
+
+#
+#  copy the data to the file with computing MD5
+def copy_with_hash(src, target):
+  md5=hashlib.md5()
+  with open(target, 'wb') as f:
+    for chunk in iter(lambda: src.read(COPY_BUF_SIZE), b''):
+      md5.update(chunk)
+      f.write(chunk)
+  return md5.hexdigest()
+
+#
+#  extract a member of the tar file, regular files are written with
+#  computing MD5. returns (size, hash) of the file, or (None, None).
+def extract_member(arc, member, to_dir):
+  target=os.path.join(to_dir, member.name)
+  if member.isdir():
+    #  the directory may be made by another thread
+    os.makedirs(target, exist_ok=True)
+    return None, None
+  if not member.isreg():
+    arc.extract(member, path=to_dir)
+    return None, None
+  os.makedirs(os.path.dirname(target), exist_ok=True)
+  h_val=copy_with_hash(arc.extractfile(member), target)
+  arc.chmod(member, target)
+  arc.utime(member, target)
+  return member.size, h_val
+
+#
+#  extract a tar file in one pass, each member is extracted as soon as
+#  its header is decoded. (name, size, hash) of extracted members are
+#  appended to 'files'. a file on disk is opened with 'r:*', a link member
+#  is extracted as a copy of its target if the link can not be made.
+#  a stream (e.g. HTTP response) is opened with 'r|*'.
+def extract_tar_stream(reader, to_dir, name, size=0, num=10, verbose=True, files=None, mode='r|*'):
+  if files is None: files=[]
+  arc=tarfile.open(fileobj=reader, mode=mode)
+  label="Extract: %s" % name
+  try:
+    for member in arc:
+      try:
+        fsize, h_val=extract_member(arc, member, to_dir)
+        files.append((member.name, fsize, h_val))
+      except:
+        error("===Fail to extract===", member.name)
+      if verbose:
+        _progress.update(reader, reader.tell(), size, label)
+  finally:
+    arc.close()
+    _progress.finish(reader)
+  return files
+
+#
+#
+@profiled('extract')
+def untar(fname, to_dir, num=10, db=None, writer=None):
   dbname=None
-  signal.signal(signal.SIGINT, signal.SIG_DFL)
+  pkgname=None
+  files=[]
+  reset_sigint()
   try:
-    arc=tarfile.open(fname)
     pkgname=file_to_pkgname(fname, getRptDir()+"\\__pkg__\\pkgs.yaml")
     if db:
       dbname=get_dbname(to_dir, db)
-      if not os.path.exists(os.path.dirname(dbname)):
-        os.makedirs(os.path.dirname(dbname))
-      insert_pkg_data(pkgname, fname, None, dbname)
-
-    members=arc.getnames()
-    n=len(members)
-    x=n/num
-    if x == 0 : x=1
-    bar = ">" + " " *num
-
-    for i in range(n):
-      try:
-        arc.extract(members[i], path=to_dir)
-        if db:
-          insert_install_info(pkgname, to_dir[2:]+"\\"+members[i], dbname)
-      except:
-        print("===Fail to extract===", members[i])
-          
-      bar = "=" * int(i/x) + ">" + " " * int((n-i)/x)
-      s="\rExtract: %s |%s|(%d%%) %s     " % (os.path.basename(fname), bar, int(i*100/n), getMonChar(i))
-      print(s, end="")
-    print ("\rExtracted:",fname, "==>", to_dir, " " *(num+10))
-    arc.close()
+      os.makedirs(os.path.dirname(dbname), exist_ok=True)
+      prefetch_pkg_deps([pkgname])
+
+    with open(fname, 'rb') as f:
+      #  no progress bar in parallel installation
+      extract_tar_stream(f, to_dir, os.path.basename(fname),
+                         os.path.getsize(fname), num, writer is None, files, 'r:*')
+      PROFILER.add_bytes(os.path.getsize(fname))
+    message("Extracted:", fname, "==>", to_dir)
+    event('install', file=os.path.basename(fname), package=pkgname, to_dir=to_dir, files=len(files))
   except:
-    print(fname,": Fail to extract...              ")
+    error(fname, ": Fail to extract...")
     #traceback.print_exc()
+  #
+  # record extracted files, even if extraction was interrupted
+  if dbname and pkgname:
+    files=[(to_dir[2:]+"\\"+x[0], x[1], x[2]) for x in files]
+    if writer:
+      writer.record(pkgname, fname, files, dbname)
+      return
     try:
-      arc.close()
+      insert_install_record(pkgname, fname, files, dbname)
     except:
-      pass
+      error(fname, ": Fail to record installed files...")
+
+#
+#  extract the package directly from the HTTP response, the tarball is
+#  not saved. the stream is checked with Content-MD5sum after extraction.
+@profiled('extract')
+def untar_url(name, to_dir, num=10, db=None):
+  dbname=None
+  pkgname=None
+  files=[]
+  h_val=None
+  ok=True
+  reset_sigint()
+  res=repo_get("pkg_download.cgi?name=%s" % name.split(',')[0], stream=True)
+  try:
+    if res.status_code != 200:
+      error("Fail to download: %s" % name)
+      return False
+    fname, size=get_attached_filename(res, name)
+    pkgname=file_to_pkgname(fname, getRptDir()+"\\__pkg__\\pkgs.yaml")
+    h_val=res.headers.get('Content-MD5sum')
+    if db:
+      dbname=get_dbname(to_dir, db)
+      os.makedirs(os.path.dirname(dbname), exist_ok=True)
+      prefetch_pkg_deps([pkgname])
+
+    res.raw.decode_content=True
+    reader=HashReader(res.raw)
+    try:
+      extract_tar_stream(reader, to_dir, fname, size, num, True, files)
+      #  read the padding after the end of archive for the hash
+      while reader.read(HASH_BUF_SIZE): pass
+      PROFILER.add_bytes(reader.count)
+      message("Extracted:", fname, "==>", to_dir)
+      event('install', file=fname, package=pkgname, to_dir=to_dir, files=len(files), stream=True)
+    except:
+      error(fname, ": Fail to extract...")
+      ok=False
+    #  the package is recorded without the hash, not to be skipped next time
+    if h_val and h_val.strip() != reader.hexdigest():
+      error("MD5 mismatch: %s" % fname)
+      ok=False
+    h_val=reader.hexdigest() if ok else None
+  finally:
+    res.close()
+  #
+  # record extracted files, even if extraction was interrupted
+  if dbname and pkgname:
+    try:
+      files=[(to_dir[2:]+"\\"+x[0], x[1], x[2]) for x in files]
+      insert_install_record(pkgname, fname, files, dbname, h_val)
+    except:
+      error(fname, ": Fail to record installed files...")
+  return ok
 
 #
 #
@@ -473,36 +2071,55 @@ def check_pkg_installed(fname, to_pkgdir):
   except:
     return False
 #
+#  compare the hash of installed package with the catalog entry
+def is_pkg_installed(info, to_pkgdir):
+  try:
+    dbname=get_dbname(to_pkgdir, PKG_DB)
+    data=select_pkg_data(info['package'], dbname)
+    return bool(data) and data[0][4] == info['MD5sum']
+  except:
+    return False
+#
 #
-def file_to_pkgname(fname, pkgpath="__pkg__/pkgs.yaml"):
-  data=load_yaml(pkgpath)
-  ffname=os.path.basename(fname)
-  for x in data:
-    if ffname == os.path.basename( x['filename']) :  return x['package']
-  print("Unknown pkg:", fname)
+def file_to_pkgname(fname, pkgpath=None):
+  x=get_catalog(pkgpath).files.get(os.path.basename(fname))
+  if x : return x['package']
+  error("Unknown pkg:", fname)
   return fname.replace(".tgz", "")
 
-def pkgname_to_file(p, pkgpath="__pkg__/pkgs.yaml"):
-  data=load_yaml(pkgpath)
-  for x in data:
-    pname=x['package'].split(',')
-    if p in pname:  return os.path.basename(x['filename'])
+def pkgname_to_file(p, pkgpath=None):
+  x=get_catalog(pkgpath).names.get(p)
+  if x : return os.path.basename(x['filename'])
   return None
 
 
 #
 def get_filename(name):
-  lst=load_pkg_list(getRptDir()+"\\__pkg__\\pkgs.yaml")
-  try:
-    for x in lst:
-      if name == lst[x]['package']:
-        return lst[x]['filename']
-  except:
-    return None
+  x=get_catalog().packages.get(name)
+  if x : return x['filename']
+  return None
+
+#
+#  directory to extract the package file to, and the database name
+#  returns (None, None) if the package should not be installed
+def get_install_dir(fname, dname):
+  to_libdir=dname+"\\local"
+  to_pkgdir=dname+"\\opt"
+
+  if PKG_PREFIX in fname:
+    return to_pkgdir, PKG_DB
+  if "setup" in fname:
+    if not os.path.exists(to_pkgdir+"\\start_ros.bat"):
+      return to_pkgdir, None
+    return None, None
+  ff=file_to_pkgname(os.path.basename(fname), getRptDir()+"\\__pkg__\\pkgs.yaml")
+  if 'opt_local' in get_filename(ff):
+    return to_pkgdir, PKG_DB
+  return to_libdir, PKG_DB
 
 #
 #  install package file
-def install_package(fname, dname, flag=False, verbose=False):
+def install_package(fname, dname, flag=False, verbose=False, writer=None):
   to_libdir=dname+"\\local"
   to_optlibdir=dname+"\\opt\\local"
   to_pkgdir=dname+"\\opt"
@@ -512,29 +2129,187 @@ def install_package(fname, dname, flag=False, verbose=False):
   if not os.path.exists(to_pkgdir) :
     os.makedirs(to_pkgdir)
 
-  signal.signal(signal.SIGINT, signal.SIG_DFL)
+  reset_sigint()
 
   ff=file_to_pkgname(os.path.basename(fname), getRptDir()+"\\__pkg__\\pkgs.yaml")
 
-  if PKG_PREFIX in fname:
-    if flag or not check_pkg_installed(fname, to_pkgdir):
-      untar(fname, to_pkgdir, 10, PKG_DB)
-    else:
-      if verbose:
-        print("Skip install", ff)
+  if "setup" in fname and not PKG_PREFIX in fname:
+    to_dir, db=get_install_dir(fname, dname)
+    if to_dir:
+      untar(fname, to_dir, 10, None, writer)
+  elif flag or not check_pkg_installed(fname, to_pkgdir):
+    to_dir, db=get_install_dir(fname, dname)
+    untar(fname, to_dir, 10, db, writer)
   else:
-    if "setup" in fname:
-      if not os.path.exists(to_pkgdir+"\\start_ros.bat"):
-        untar(fname, to_pkgdir)
-    else:
-      if flag or not check_pkg_installed(fname, to_pkgdir):
-        if 'opt_local' in get_filename(ff):
-          untar(fname, to_pkgdir, 10, PKG_DB)
-        else: 
-          untar(fname, to_libdir, 10, PKG_DB)
-      else:
-        if verbose :
-          print("Skip install", ff)
+    if verbose:
+      message("Skip install", ff)
+
+#
+#  install package from the repository without saving the tarball
+def install_package_url(name, dname, flag=False, verbose=False):
+  to_pkgdir=dname+"\\opt"
+  os.makedirs(dname+"\\local", exist_ok=True)
+  os.makedirs(to_pkgdir, exist_ok=True)
+
+  info=get_pkg_info_from_yaml(name)
+  if info is None:
+    error("Unknown pkg:", name)
+    return False
+  fname=os.path.basename(info['filename'])
+  if not flag and is_pkg_installed(info, to_pkgdir):
+    if verbose:
+      message("Skip install", info['package'])
+    return True
+
+  to_dir, db=get_install_dir(fname, dname)
+  if to_dir is None:
+    return True
+  return untar_url(name, to_dir, 10, db)
+
+#
+#  install package files in parallel, a package is started after the
+#  packages it depends on ('depend' in pkgs.yaml) have been installed.
+#  callback(fname, count, total) is called when each package is finished.
+def install_package_files(fnames, dname, workers=None, flag=False, verbose=False, callback=None):
+  if workers is None: workers=INSTALL_WORKERS
+  os.makedirs(dname+"\\local", exist_ok=True)
+  os.makedirs(dname+"\\opt", exist_ok=True)
+  cat=get_catalog()
+
+  owner={}
+  for f in fnames:
+    x=cat.files.get(os.path.basename(f))
+    if x:
+      for p in x['package'].split(','): owner[p]=f
+  deps={}
+  for f in fnames:
+    x=cat.files.get(os.path.basename(f))
+    deps[f]=set()
+    if x:
+      deps[f]=set([owner[p] for p in x['depend'] if p in owner and owner[p] != f])
+  #  run_dep/lib_dep of packages which are not in the catalog
+  prefetch_pkg_deps([os.path.basename(f).replace(PKG_EXT, "") for f in fnames
+                     if not cat.files.get(os.path.basename(f))])
+
+  errors={}
+  pending=list(fnames)
+  done=set()
+  running={}
+  writer=DBWriter()
+  try:
+    with futures.ThreadPoolExecutor(max_workers=workers) as ex:
+      while pending or running:
+        ready=[f for f in pending if deps[f] <= done]
+        if not ready and not running:
+          error("Circular dependency:", ",".join([os.path.basename(f) for f in pending]))
+          ready=list(pending)
+        for f in ready:
+          pending.remove(f)
+          running[ex.submit(install_package, f, dname, flag, verbose, writer)]=f
+
+        finished, _=futures.wait(list(running), return_when=futures.FIRST_COMPLETED)
+        for fut in finished:
+          f=running.pop(fut)
+          try:
+            fut.result()
+          except Exception as e:
+            errors[f]=str(e) or e.__class__.__name__
+          done.add(f)
+          if callback: callback(f, len(done), len(fnames))
+  finally:
+    writer.close()
+  return errors
+
+#
+#  upgrade the installed package with the package file. only added or
+#  changed files are written, and files not in the new package are removed.
+@profiled('extract')
+def upgrade_package(fname, dname, name=None, verbose=True):
+  reset_sigint()
+  to_dir, db=get_install_dir(fname, dname)
+  pkgname=file_to_pkgname(os.path.basename(fname), getRptDir()+"\\__pkg__\\pkgs.yaml")
+  if name is None: name=pkgname.split(',')[0]
+  if to_dir is None or db is None:
+    install_package(fname, dname, True, verbose)
+    return True
+  dbname=get_dbname(to_dir, db)
+  old=select_install_manifest(name, dbname)
+  if not old:
+    install_package(fname, dname, True, verbose)
+    return True
+  refs=count_path_refs(name, dbname)
+  prefetch_pkg_deps([pkgname])
+
+  files=[]
+  written=0
+  try:
+    with open(fname, 'rb') as f:
+      arc=tarfile.open(fileobj=f, mode='r:*')
+      try:
+        for member in arc:
+          path=to_dir[2:]+"\\"+member.name
+          try:
+            prev=old.get(path)
+            if member.isreg() and prev and prev[0] == member.size and prev[1]:
+              fsize, h_val, changed=update_member(arc, member, to_dir, prev[1])
+            else:
+              fsize, h_val=extract_member(arc, member, to_dir)
+              changed=member.isreg()
+            files.append((path, fsize, h_val))
+            if changed: written += 1
+          except Exception:
+            #  the old file (e.g. locked) is kept in the record, not removed
+            error("===Fail to extract===", member.name)
+            if path in old: files.append((path,)+tuple(old[path]))
+      finally:
+        arc.close()
+  except (OSError, tarfile.TarError) as e:
+    #  the old files and the record are kept
+    error(os.path.basename(fname), ": Fail to upgrade...", e)
+    return False
+
+  new_paths=set([x[0] for x in files])
+  removed=[dname+x for x in old if not x in new_paths and not x in refs]
+  remove_paths(removed, dname)
+
+  with closing(open_pkg_db(dbname)) as conn:
+    cond, params=pkgname_matching_pattern(name)
+    conn.execute("delete from install_info where %s" % cond, params)
+    conn.execute("delete from packages where %s" % cond, params)
+    insert_install_record(pkgname, fname, files, dbname, None, conn)
+  if verbose:
+    message("Upgraded: %s (%d written, %d removed, %d unchanged)" %
+            (os.path.basename(fname), written, len(removed), len(files)-written))
+  event('upgrade', file=os.path.basename(fname), package=name, written=written,
+        removed=len(removed), unchanged=len(files)-written)
+  return True
+
+#
+#  extract a regular file only if it differs from the installed file.
+#  returns (size, hash, written)
+def update_member(arc, member, to_dir, h_val):
+  target=os.path.join(to_dir, member.name)
+  try:
+    if os.path.getsize(target) != member.size:
+      raise OSError
+  except OSError:
+    fsize, h_val2=extract_member(arc, member, to_dir)
+    return fsize, h_val2, True
+
+  with tempfile.SpooledTemporaryFile(max_size=UPGRADE_SPOOL_SIZE) as tmp:
+    md5=hashlib.md5()
+    src=arc.extractfile(member)
+    for chunk in iter(lambda: src.read(COPY_BUF_SIZE), b''):
+      md5.update(chunk)
+      tmp.write(chunk)
+    if md5.hexdigest() == h_val:
+      return member.size, h_val, False
+    tmp.seek(0)
+    with open(target, 'wb') as f:
+      shutil.copyfileobj(tmp, f, COPY_BUF_SIZE)
+  arc.chmod(member, target)
+  arc.utime(member, target)
+  return member.size, md5.hexdigest(), True
 
 #
 # install all package files
@@ -544,6 +2319,56 @@ def install_package_all(path, dname, flag=False, verbose=False):
   for fname in f_list:
     install_package(fname, dname, flag, verbose)
 
+########################################
+# Verify installed files
+#
+#  check a file against the size and hashes recorded at installation,
+#  a path installed by several packages is OK if it matches one of them.
+#  returns None or 'missing', 'size', 'modified'
+def verify_file(fname, records, fast=False):
+  try:
+    st=os.stat(fname)
+  except OSError:
+    return 'missing'
+  sizes=[x[0] for x in records if x[0] is not None]
+  if not stat.S_ISREG(st.st_mode) or not sizes:
+    return None
+  if not st.st_size in sizes:
+    return 'size'
+  hashes=[x[1] for x in records if x[0] == st.st_size and x[1]]
+  if fast or not hashes:
+    return None
+  if get_hash_value(fname, False) in hashes:
+    return None
+  return 'modified'
+
+#
+#  verify installed files of the package in parallel threads (hashlib
+#  releases the GIL while hashing large buffers).
+#  returns (number of files, [(path, problem, packages)])
+def verify_pkg_files(name, drv, fast=False, workers=None):
+  if workers is None: workers=INSTALL_WORKERS
+  dbname=default_pkgmgr_db(drv)
+  paths={}
+  for pkg, path, size, h_val in select_install_files(name, dbname):
+    paths.setdefault(path, []).append((pkg, size, h_val))
+  items=list(paths.items())
+
+  def _verify(item):
+    path, recs=item
+    return path, verify_file(drv+path, [(x[1], x[2]) for x in recs], fast)
+
+  problems=[]
+  done=0
+  with futures.ThreadPoolExecutor(max_workers=max(workers, 1)) as ex:
+    for path, res in ex.map(_verify, items, chunksize=64):
+      done += 1
+      _progress.update('verify', done, len(items), "Verify")
+      if res:
+        problems.append((path, res, sorted(set([x[0] for x in paths[path]]))))
+  _progress.finish('verify')
+  return len(items), problems
+
 ########################################
 # Pkgs.yaml
 #
@@ -653,77 +2478,311 @@ def save_yaml(fname, data):
 def load_yaml(fname):
   data=[]
   with open(fname, "r") as f:
-    try:
-      data=yaml.load(f, Loader=yaml.FullLoader)
-    except:
-      data=yaml.load(f)
-
+    data=parse_yaml(f)
     f.close()
   return data
 
 #
-#
-def load_pkg_list(path="__pkg__/pkgs.yaml"):
-  data=load_yaml(path)
-  res={}
-  for x in data:
-    pkgs=x['package'].split(',')
-    for p in pkgs:
-      res[p]=x
+#  merge changed and removed entries into the catalog, changed entries
+#  replace the entries of the same 'package' and new entries are appended.
+def merge_catalog(entries, changed, removed):
+  changed=dict([(x['package'], x) for x in changed])
+  removed=set(removed)
+  res=[]
+  for x in entries:
+    name=x['package']
+    if name in removed: continue
+    res.append(changed.pop(name, x))
+  res.extend(changed.values())
   return res
 
-def load_pkg_hash(path="__pkg__/pkgs.yaml"):
-  data=load_yaml(path)
-  res={}
-  for x in data:
-    res[x['package']] = x['MD5sum']
-  return res
+#
+#  the merged catalog is saved in JSON (a subset of YAML), which is
+#  parsed much faster than YAML.
+def save_catalog(fname, entries):
+  tmp=fname+".tmp"
+  with open(tmp, "w") as f:
+    f.write("[\n" + ",\n".join([json.dumps(x, default=str) for x in entries]) + "\n]\n")
+  os.replace(tmp, fname)
 
-def get_pkg_info_from_yaml(name, path="__pkg__/pkgs.yaml"):
-  data=load_yaml(path)
-  for v in data:
-    names=v['package'].split(',')
-    if name in names:
-      return v
-  
-def get_depend(pname, deps, info):
-  if pname in info:
-    dep=info[pname]['depend']
-    for x in dep:
-      if not x in deps:
-        deps.append(x)
-        get_depend(x, deps, info)
-    return deps
-  else:
-    return deps
+@profiled('catalog')
+def parse_catalog(data):
+  if data.lstrip()[:1] == b'[':
+    try:
+      return json.loads(data.decode('utf-8'))
+    except ValueError:
+      pass
+  return parse_yaml(data.decode('utf-8'))
+
+@profiled('catalog')
+def parse_yaml(stream):
+  try:
+    return yaml.load(stream, Loader=yaml.FullLoader)
+  except AttributeError:
+    return yaml.load(stream)
+
+#
+#  package catalog (pkgs.yaml), parsed once and indexed.
+#  it is reloaded when the mtime/size and the hash of the file are changed.
+class PkgCatalog:
+  def __init__(self, path):
+    self.path=path
+    self.stat=None
+    self.h_val=None
+    self.entries=[]
+    self.names={}      # each package name (alias) -> entry
+    self.packages={}   # 'package' field -> entry
+    self.files={}      # basename of 'filename' -> entry
+    self.hashes={}     # 'package' field -> MD5sum
+    self.resolver=None
+    self.lock=threading.RLock()
+
+  def refresh(self):
+    with self.lock:
+      st=os.stat(self.path)
+      key=(st.st_mtime_ns, st.st_size)
+      if key == self.stat:
+        return self
+      with open(self.path, "rb") as f:
+        data=f.read()
+      h_val=hashlib.md5(data).hexdigest()
+      if h_val != self.h_val:
+        self.load(parse_catalog(data) or [])
+        self.h_val=h_val
+      self.stat=key
+    return self
+
+  def load(self, data):
+    names={}
+    packages={}
+    files={}
+    hashes={}
+    for x in data:
+      for p in x['package'].split(','):
+        names[p]=x
+      packages[x['package']]=x
+      hashes[x['package']]=x.get('MD5sum')
+      files.setdefault(os.path.basename(x['filename']), x)
+    self.entries=data
+    self.names=names
+    self.packages=packages
+    self.files=files
+    self.hashes=hashes
+    self.resolver=None
+
+_catalogs={}
+_catalogs_lock=threading.Lock()
+
+def default_catalog_path():
+  return getRptDir()+"\\__pkg__\\pkgs.yaml"
+
+def get_catalog(path=None):
+  if path is None: path=default_catalog_path()
+  key=os.path.abspath(path)
+  with _catalogs_lock:
+    if not key in _catalogs:
+      _catalogs[key]=PkgCatalog(path)
+    cat=_catalogs[key]
+  return cat.refresh()
+
+#
+#
+def load_pkg_list(path=None):
+  return get_catalog(path).names
+
+def load_pkg_hash(path=None):
+  return get_catalog(path).hashes
+
+def get_pkg_info_from_yaml(name, path=None):
+  return get_catalog(path).names.get(name)
+
+#
+#  search index: an inverted index of tokens in names, descriptions and
+#  maintainers, built by 'update'. tokens are matched by prefix with the
+#  index of the token column, and packages are ranked by the weights.
+SEARCH_WEIGHTS={ 'name': 10.0, 'name_part': 5.0, 'maintainer': 2.0, 'description': 1.0 }
+
+def search_tokens(text):
+  return [x for x in re.findall(r"[a-z0-9]+", str(text or "").lower()) if len(x) > 1 or x.isdigit()]
+
+def default_search_db(path=None):
+  if path is None: path=default_catalog_path()
+  return os.path.join(os.path.dirname(path), SEARCH_DB)
+
+def open_search_db(dbname):
+  conn=sqlite3.connect(dbname, timeout=10)
+  conn.execute("create table if not exists search_meta (key text primary key, value text)")
+  conn.execute("create table if not exists search_pkg (id integer primary key, name text, description text)")
+  conn.execute("create table if not exists search_token (token text, pkg integer, weight real)")
+  conn.execute("create index if not exists search_token_index on search_token(token)")
+  return conn
+
+def catalog_stamp(path):
+  st=os.stat(path)
+  return "%d:%d" % (st.st_mtime_ns, st.st_size)
+
+#
+#  (re)build the index, if the catalog is changed
+def build_search_index(path=None, dbname=None, force=False):
+  if path is None: path=default_catalog_path()
+  if dbname is None: dbname=default_search_db(path)
+  with closing(open_search_db(dbname)) as conn:
+    res=conn.execute("select value from search_meta where key='catalog'").fetchall()
+    if not force and res and res[0][0] == catalog_stamp(path):
+      return False
+    pkgs=[]
+    rows=[]
+    for i, x in enumerate(get_catalog(path).entries):
+      name=x['package'].split(',')[0]
+      pkgs.append((i, name, str(x.get('description') or "").strip()))
+      weights={}
+      for t in search_tokens(x['package'].replace(',', ' ')):
+        weights[t]=max(weights.get(t, 0), SEARCH_WEIGHTS['name_part'])
+      for p in x['package'].split(','):
+        weights[p.lower()]=SEARCH_WEIGHTS['name']
+      for field in ('maintainer', 'description'):
+        for t in search_tokens(x.get(field)):
+          weights[t]=max(weights.get(t, 0), SEARCH_WEIGHTS[field])
+      rows.extend([(t, i, w) for t, w in weights.items()])
+    with conn:
+      conn.execute("delete from search_pkg")
+      conn.execute("delete from search_token")
+      conn.executemany("insert into search_pkg (id, name, description) values (?,?,?)", pkgs)
+      conn.executemany("insert into search_token (token, pkg, weight) values (?,?,?)", rows)
+      conn.execute("insert or replace into search_meta (key, value) values ('catalog', ?)",
+                   (catalog_stamp(path),))
+  return True
+
+def query_index_valid(path, dbname):
+  try:
+    with closing(open_search_db(dbname)) as conn:
+      res=conn.execute("select value from search_meta where key='catalog'").fetchall()
+    return bool(res) and res[0][0] == catalog_stamp(path)
+  except (OSError, sqlite3.Error):
+    return False
 
+#
+#  packages matching all tokens of the query (prefix match), ranked by
+#  the sum of the weights. the query is split by search_tokens() as the
+#  index is, an exact token match counts double and a word matching
+#  a whole package name (e.g. 'nav-core') gets the weight of the name.
+#  returns [(name, description, score)]
+def search_packages(query, path=None, limit=None):
+  if path is None: path=default_catalog_path()
+  dbname=default_search_db(path)
+  if not os.path.exists(dbname) or not query_index_valid(path, dbname):
+    build_search_index(path, dbname, True)
+  words=search_tokens(query)
+  if not words: return []
+  names=[x.lower().replace('-', '_') for x in query.split()]
+  with closing(open_search_db(dbname)) as conn:
+    scores=None
+    for w in words:
+      res={}
+      for pkg, token, weight in conn.execute(
+          "select pkg, token, weight from search_token where token >= ? and token < ?", (w, w+"\uffff")):
+        res[pkg]=res.get(pkg, 0) + (weight*2 if token == w else weight)
+      if scores is None:
+        scores=res
+      else:
+        scores=dict([(k, v + res[k]) for k, v in scores.items() if k in res])
+      if not scores: return []
+    for w in set(names) - set(words):
+      for pkg, weight in conn.execute("select pkg, weight from search_token where token=?", (w,)):
+        if pkg in scores: scores[pkg] += weight
+    result=[(name, desc, scores[pkg])
+            for pkg, name, desc in conn.execute("select id, name, description from search_pkg")
+            if pkg in scores]
+  result.sort(key=lambda x: (-x[2], x[0]))
+  if limit: result=result[:limit]
+  return result
+
+#
+#  dependency resolver over the package names of the catalog.
+#  closures are computed by an iterative DFS and memoized, and
+#  the reverse dependencies are indexed once.
+class DepResolver:
+  def __init__(self, info):
+    self.info=info
+    self.closures={}
+    self.lock=threading.Lock()
+    self.rdeps={}
+    for x in info:
+      for d in info[x]['depend'] or []:
+        self.rdeps.setdefault(d, []).append(x)
+
+  def depends(self, name):
+    if name in self.info:
+      return self.info[name]['depend'] or []
+    return []
+
+  #
+  #  topological order (dependencies first) of names and their dependencies,
+  #  and the list of circular dependencies found.
+  def toposort(self, names):
+    order=[]
+    cycles=[]
+    state={}   # 1: visiting, 2: done
+    for root in names:
+      if root in state: continue
+      state[root]=1
+      path=[root]
+      stack=[iter(self.depends(root))]
+      while stack:
+        for d in stack[-1]:
+          st=state.get(d)
+          if st is None:
+            state[d]=1
+            path.append(d)
+            stack.append(iter(self.depends(d)))
+            break
+          elif st == 1:
+            cycles.append(path[path.index(d):]+[d])
+        else:
+          stack.pop()
+          node=path.pop()
+          state[node]=2
+          order.append(node)
+    return order, cycles
+
+  #
+  #  all dependencies of the package in topological order (memoized)
+  def closure(self, name):
+    with self.lock:
+      if not name in self.closures:
+        self.closures[name]=self.toposort([name])
+      return self.closures[name]
+
+  def reverse_depends(self, name):
+    return self.rdeps.get(name, [])
+
+def get_resolver(path=None):
+  cat=get_catalog(path)
+  with cat.lock:
+    if cat.resolver is None:
+      cat.resolver=DepResolver(cat.names)
+    return cat.resolver
+
+@profiled('resolve')
 def get_depends(pname):
-  deps=[]
   info = load_pkg_list(getRptDir()+"\\__pkg__\\pkgs.yaml")
-  get_depend(pname, deps, info)
-  deps.append(pname)
-  deps.sort()
+  order, cycles=get_resolver(getRptDir()+"\\__pkg__\\pkgs.yaml").closure(pname)
+  deps=sorted(set(order) | set([pname]))
   return deps, info
 
 def get_dep_lib(pname):
   deps, info=get_depends(pname)
-  pkg_list=list(info.keys())
   libs=[]
   pkgs=[]
   for x in deps:
-    if x in pkg_list:
+    if x in info:
       pkgs.append(x)
     else:
       libs.append(x)
   return pkgs, libs
 
 def get_depend_pkgs(name):
-  info=load_pkg_list(getRptDir()+"\\__pkg__\\pkgs.yaml")
-  res=[]
-  for x in list(info.keys()):
-    if name  in info[x]['depend']:
-      res.append(x)
-  return res
+  return list(get_resolver(getRptDir()+"\\__pkg__\\pkgs.yaml").reverse_depends(name))
 
 if __name__ == '__main__':
   fname=sys.argv[1]
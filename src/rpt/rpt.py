@@ -4,9 +4,11 @@ import sys,os
 import signal
 import ros4win as r4w
 import traceback
+import time
 
 signal.signal(signal.SIGINT, signal.SIG_DFL)
 cmds=[]
+options={'stream': False, 'profile': None, 'trace': None, 'fast': False, 'exit': 0}
 
 #
 # 
@@ -46,7 +48,7 @@ def installed_pkgs():
   drv = getArgCwd(2)
   res=r4w.get_installed_pkgs(drv)
   for x in res:
-    print(x)
+    r4w.message(x)
 #cmds.append(installed_pkgs)
 
 def getRptDir():
@@ -67,7 +69,7 @@ def installed_files():
   dbname=r4w.default_pkgmgr_db(drv)
   res=r4w.select_install_info(name, dbname)
   for x in res:
-    print(x)
+    r4w.message(x)
 #cmds.append(installed_files)
 
 
@@ -80,12 +82,14 @@ def check():
     lst=package_list(drv)
     res = pname in lst
     if res:
-      print(pname, "OK")
+      r4w.message(pname, "OK")
     else:
-      print("--")
+      r4w.message("--")
+    r4w.event('check', package=pname, installed=res)
     return res
   except:
-    print("No package")
+    r4w.message("No package")
+    r4w.event('check', package=pname, installed=False)
     return False
 cmds.append(check)
 
@@ -136,10 +140,12 @@ def list():
     lst=sorted(lst.items())
 
     for x in lst:
-      print("   - "+x[0])
+      r4w.message("   - "+x[0])
+    r4w.event('list', packages=[x[0] for x in lst])
     return lst
   except:
-    print("No package")
+    r4w.message("No package")
+    r4w.event('list', packages=[])
     return []
 cmds.append(list)
 
@@ -158,15 +164,16 @@ def update():
         if lst_pkg[x] != lst[x]:
           res.append(x.split(',')[0])
       except:
-        print("== ERROR: no such package [",x, "]")
+        r4w.error("== ERROR: no such package [",x, "]")
     if len(res):
-      print("[%s]" % ",".join(res))
-      print(" %d updates..." % len(res))
+      r4w.message("[%s]" % ",".join(res))
+      r4w.message(" %d updates..." % len(res))
     else:
-      print("No update")
+      r4w.message("No update")
+    r4w.event('update', upgradable=res)
   except:
-    traceback.print_exc()
-    print("Update package list")
+    if r4w.OUTPUT_MODE == 'text': traceback.print_exc()
+    r4w.message("Update package list")
 cmds.append(update)
 
 #
@@ -180,30 +187,35 @@ def upgrade():
     if lst_pkg[x] != lst[x]:
       res.append(x.split(',')[0])
   if len(res) == 0 :
-    print("No upgradable package")
+    r4w.message("No upgradable package")
+    r4w.event('upgrade_summary', packages=[])
     return
-  print("[%s]" % ",".join(res))
-  print(" %d packages, update ? (Y/n) " % len(res), end="")
-  str=input().strip()
+  str=""
+  if r4w.OUTPUT_MODE == 'text':
+    print("[%s]" % ",".join(res))
+    print(" %d packages, update ? (Y/n) " % len(res), end="")
+    str=input().strip()
   if str == "n":
     print("...Canceled")
   else:
-    print("Start upgrade packages")
+    r4w.message("Start upgrade packages")
     files=[]
     path= getRptDir()+"\\ros_pkg"
     for name in res:
       f=r4w.download_package_file(name, path)
       files.append(f)
 
-    for name in res:
-      print("remove package", name)
-      r4w.remove_pkg_file_all(name, drv)
-
-    for f in files:
+    errors=[]
+    for name, f in zip(res, files):
+      if not f:
+        errors.append(name)
+        continue
       fname=path+"\\"+f
-      print("Update file", fname)
-
-      r4w.install_package(fname, drv, False, True)
+      r4w.message("Update file", fname)
+      if not r4w.upgrade_package(fname, drv, name, True):
+        errors.append(name)
+    r4w.prune_pkg_cache(drv, path)
+    r4w.event('upgrade_summary', packages=res, errors=errors)
 cmds.append(upgrade)
 #
 #
@@ -213,11 +225,70 @@ def remove():
   r4w.remove_pkg_file_all(pkg_name, drv)
 cmds.append(remove)
 
+#
+#  verify installed files: rpt verify [pkg|all] [drive]
+def verify():
+  name=sys.argv[2] if len(sys.argv) > 2 else "all"
+  drv = getArgCwd(3)
+  t=time.time()
+  n, problems=r4w.verify_pkg_files(name, drv, options['fast'])
+  for path, res, pkgs in problems:
+    r4w.message("%-8s %s (%s)" % (res.upper(), path, ",".join(pkgs)))
+  r4w.message("%d files, %d problems (%.1f sec)" % (n, len(problems), time.time()-t))
+  r4w.event('verify', package=name, files=n, fast=options['fast'],
+            problems=[{ 'path': x[0], 'problem': x[1], 'packages': x[2] } for x in problems])
+  if problems:
+    options['exit']=1
+cmds.append(verify)
+
+#
+#  package cache: rpt cache stats|prune [drive]
+def cache():
+  sub=sys.argv[2] if len(sys.argv) > 2 else "stats"
+  drv = getArgCwd(3)
+  path = getRptDir()+"\\ros_pkg"
+  pinned=r4w.get_installed_hashes(drv)
+  if sub == "prune":
+    res=r4w.get_pkg_cache(path).prune(pinned)
+    for x in res:
+      r4w.message("   - "+x)
+    r4w.message(" %d files removed" % len(res))
+    r4w.event('cache', action='prune', path=path, removed=res)
+  else:
+    st=r4w.get_pkg_cache(path).stats(pinned)
+    r4w.message("Cache: %s" % path)
+    r4w.message("   files : %d (%d pinned)" % (st['count'], st['pinned']))
+    r4w.message("   size  : %.1f MB / %.1f MB (%.1f MB pinned)" %
+                (st['size']/1024**2, st['max_size']/1024**2, st['pinned_size']/1024**2))
+    if st['count']:
+      r4w.message("   used  : %s - %s" % (st['oldest'], st['newest']))
+    r4w.event('cache', action='stats', path=path, **st)
+cmds.append(cache)
+
+#
+#  mirrors of the repository: rpt mirrors [probe]
+def mirrors():
+  m=r4w.get_mirrors()
+  if len(sys.argv) > 2 and sys.argv[2] == "probe":
+    m.probe(True)
+  now=time.time()
+  for i, x in enumerate(m.order()):
+    st=m.stats[x]
+    rtt="%7.1f ms" % (st['rtt']*1000) if st['rtt'] is not None else "      - ms"
+    bps="%7.1f MB/s" % (st['throughput']/1024**2) if st['throughput'] else "      - MB/s"
+    state="down %d sec" % (st['retry_at']-now) if st['retry_at'] > now else "ok"
+    r4w.message(" %d. %s" % (i+1, x))
+    r4w.message("      rtt %s  throughput %s  %d ok, %d failed  %s" % (rtt, bps, st['ok'], st['failed'], state))
+  r4w.event('mirrors', mirrors=[dict(st, mirror=x) for x, st in m.stats.items()])
+cmds.append(mirrors)
+
 #
 #
 def update_cache(pkg_dir=None):
   if pkg_dir is None:  pkg_dir=getRptDir()+"\\__pkg__"
-  r4w.download_package_file("list", pkg_dir)
+  fname=r4w.download_catalog(pkg_dir)
+  if fname:
+    r4w.build_search_index(pkg_dir+"\\"+fname)
 
 #
 #
@@ -230,51 +301,115 @@ def download(name="", path=None):
 
 #
 #
-def download_all(path=None):
+def download_all(path=None, name=None):
   if path is None:  path = getRptDir()+"\\ros_pkg"
-  name=sys.argv[2]
-  if len(sys.argv) > 3:  path=sys.argv[3]
+  if name is None:
+    name=sys.argv[2]
+    if len(sys.argv) > 3:  path=sys.argv[3]
 
   pkgs, info=r4w.get_depends(name)
-  files=[]
-  count=1
-  n=len(pkgs)
-  
-  for x in pkgs:
-    try:
-      fname=r4w.download_package_file(x, path)
-      #fname=r4w.pkgname_to_file(x)
-      files.append(fname)
-      v=r4w.getMonDots(count)
-      y=int(count/n * 100)
-      print("Download: %s  [%d]%%\r" % (v, y), end="", flush=True)
-    except:
-      print("ERROR: [", x, "]                   ", flush=True)
-      pass
-    count += 1
+
+  def progress(x, count, n):
+    r4w.get_progress().update('download', count, n, "Download: [%d/%d]" % (count, n))
+
+  files, errors=r4w.download_package_files(pkgs, path, r4w.DL_WORKERS, progress)
+  r4w.get_progress().finish('download')
+  for x in errors:
+    r4w.error("ERROR: [", x, "]", errors[x])
+  r4w.event('download_summary', packages=len(pkgs), files=len(files), errors=len(errors))
   return files
 #cmds.append(download_all)
 
 #
 #
 def install(path=None):
+  if options['stream']:
+    return install_stream()
   if path is None:  path = getRptDir()+"\\ros_pkg"
   files=download_all(path)
-  print("Finish downloading files....")
-  n=len(files)
+  r4w.message("Finish downloading files....")
+  install_files([path+"\\"+f for f in files], os.getcwd()[:2], path)
+cmds.append(install)
+
+def install_files(files, dname, path):
+  def progress(fname, count, n):
+    r4w.get_progress().update('install', count, n, "Install: [%d/%d]" % (count, n))
+
+  errors=r4w.install_package_files(files, dname, r4w.INSTALL_WORKERS, False, False, progress)
+  r4w.get_progress().finish('install')
+  for f in errors:
+    r4w.error("ERROR: [", os.path.basename(f), "]", errors[f])
+  r4w.prune_pkg_cache(dname, path)
+  r4w.event('install_summary', packages=len(files), errors=len(errors))
+
+#
+#  offline installation: rpt bundle export <pkg> <file>
+#                        rpt bundle import <file> [drive]
+def bundle():
+  sub=sys.argv[2] if len(sys.argv) > 2 else ""
+  path=getRptDir()+"\\ros_pkg"
+  if sub == "export" and len(sys.argv) > 4:
+    name, fname=sys.argv[3], sys.argv[4]
+    pkgs, info=r4w.get_depends(name)
+    files=download_all(path, name)
+    if len(files) < len(pkgs):
+      r4w.error("Bundle is not written:", len(pkgs)-len(files), "packages are not downloaded")
+      options['exit']=1
+      return
+    manifest=r4w.export_bundle(name, [path+"\\"+f for f in files], fname)
+    r4w.message("%s: %d packages" % (fname, len(manifest['packages'])))
+  elif sub == "import" and len(sys.argv) > 3:
+    manifest, files=r4w.import_bundle(sys.argv[3], path)
+    r4w.build_search_index()
+    r4w.message("Import %s: %d packages" % (manifest['package'], len(files)))
+    install_files(files, getArgCwd(4), path)
+    if len(files) < len(manifest['packages']):
+      options['exit']=1
+  else:
+    r4w.error("Usage: rpt bundle export <pkg> <file> | import <file> [drive]")
+cmds.append(bundle)
+
+#
+#  install packages from the repository without saving tarballs (--stream)
+def install_stream():
+  name=sys.argv[2]
   dname=os.getcwd()[:2]
-  to_pkgdir=dname+"\\opt"
+  pkgs, info=r4w.get_depends(name)
+  n=len(pkgs)
   count=1
+  errors=[]
 
-  for fname in files:
-    ff=r4w.file_to_pkgname(fname, getRptDir()+"\\__pkg__\\pkgs.yaml")
-    v=r4w.getMonChar(count)
-    y=int(count/n * 100)
-    if not r4w.check_pkg_installed(fname, to_pkgdir):
-      r4w.install_package(path+"/"+fname, dname, None, False)
-    print("\rInstall: %s  [%d]%%\r" % (v, y), end="", flush=True)
+  for x in pkgs:
+    if not r4w.install_package_url(x, dname, False, False):
+      errors.append(x)
+    r4w.get_progress().update('install', count, n, "Install: [%d/%d]" % (count, n))
     count += 1
-cmds.append(install)
+  r4w.get_progress().finish('install')
+  for x in errors:
+    r4w.error("ERROR: [", x, "] Fail to install")
+  r4w.event('install_summary', packages=n, errors=len(errors), stream=True)
+
+#
+#  dependencies of the package in install order
+def deps():
+  name=sys.argv[2]
+  order, cycles=r4w.get_resolver(getRptDir()+"\\__pkg__\\pkgs.yaml").closure(name)
+  for x in order:
+    r4w.message("   - "+x)
+  for x in cycles:
+    r4w.message("Circular dependency:", " -> ".join(x))
+  r4w.event('deps', package=name, depends=order, cycles=cycles)
+cmds.append(deps)
+
+#
+#  packages which depend on the package
+def rdeps():
+  name=sys.argv[2]
+  res=sorted(r4w.get_depend_pkgs(name))
+  for x in res:
+    r4w.message("   - "+x)
+  r4w.event('rdeps', package=name, packages=res)
+cmds.append(rdeps)
 
 #
 #
@@ -311,15 +446,15 @@ def get_pkg(path=""):
 #
 #
 def search():
-  name=sys.argv[2]
-  lst=r4w.load_pkg_list(getRptDir()+"\\__pkg__\\pkgs.yaml")
-  try:
-    for x in lst:
-      if name in x or name in lst[x]['description']:
-        print(r4w.Fore.GREEN + "\n"+ x +":")
-        print("      "+lst[x]['description'].strip())
-  except:
-    print("No such package", name)
+  name=" ".join(sys.argv[2:])
+  res=r4w.search_packages(name, getRptDir()+"\\__pkg__\\pkgs.yaml")
+  for x, desc, score in res:
+    r4w.message(r4w.Fore.GREEN + "\n"+ x +":")
+    r4w.message("      "+desc)
+  if not res:
+    r4w.message("No such package", name)
+  r4w.event('search', query=name,
+            packages=[{ 'package': x, 'description': desc, 'score': score } for x, desc, score in res])
 cmds.append(search)
 
 #
@@ -327,14 +462,75 @@ cmds.append(search)
 cmds_str=[x.__name__ for x in cmds]
 
 usage="Usage: %s cmd [arg1 arg2 ...]\n" % os.path.basename(sys.argv[0])
-usage+= "   cmd: "+", ".join(cmds_str)
-
-
+usage+= "   cmd: "+", ".join(cmds_str)+"\n"
+usage+= "   options: -j N (concurrent downloads), --install-jobs=N (parallel extraction),\n"
+usage+= "            --segments=N (connections to download a large file),\n"
+usage+= "            --stream (install without saving tarballs), --fast (verify sizes only),\n"
+usage+= "            --quiet (no progress), --json (summary events in JSON lines),\n"
+usage+= "            --profile[=FILE] (time per phase), --trace=FILE (Chrome trace)"
+
+
+
+#
+#  options: -j N, --jobs=N  (number of concurrent downloads)
+#           --stream        (install without saving tarballs)
+#           --fast          (verify sizes only, no hashing)
+#           --install-jobs=N (number of packages extracted in parallel)
+#           --segments=N    (connections to download a large file, 1: one stream)
+#           --quiet         (no progress and messages, errors to stderr)
+#           --json          (only summary events, one JSON object per line)
+#           --profile[=FILE] (report time, bytes and calls per phase)
+#           --trace=FILE    (save spans in the Chrome trace format)
+def parse_options():
+  args=[sys.argv[0]]
+  argv=sys.argv[1:]
+  while argv:
+    x=argv.pop(0)
+    if x == '-j' and argv:
+      r4w.DL_WORKERS=max(int(argv.pop(0)), 1)
+    elif x.startswith('--jobs='):
+      r4w.DL_WORKERS=max(int(x[7:]), 1)
+    elif x.startswith('--install-jobs='):
+      r4w.INSTALL_WORKERS=max(int(x[15:]), 1)
+    elif x.startswith('--segments='):
+      r4w.SEGMENT_WORKERS=max(int(x[11:]), 1)
+    elif x == '--stream':
+      options['stream']=True
+    elif x == '--fast':
+      options['fast']=True
+    elif x == '--quiet':
+      r4w.OUTPUT_MODE='quiet'
+    elif x == '--json':
+      r4w.OUTPUT_MODE='json'
+    elif x == '--profile' or x.startswith('--profile='):
+      options['profile']=x[10:] or True
+    elif x.startswith('--trace='):
+      options['trace']=x[8:]
+    else:
+      args.append(x)
+  sys.argv[:]=args
+
+#
+#  report of --profile and --trace
+def profile_report():
+  prof=r4w.PROFILER
+  if options['trace']:
+    prof.save_trace(options['trace'])
+  if options['profile'] is True:
+    if r4w.OUTPUT_MODE == 'json':
+      r4w.event('profile', **prof.report())
+    elif r4w.OUTPUT_MODE == 'text':
+      print(prof.format_report())
+  elif options['profile']:
+    prof.save_report(options['profile'])
 
 def main():
+  parse_options()
   if len(sys.argv) < 2:
     print(usage)
     sys.exit()
+  if options['profile'] or options['trace']:
+    r4w.PROFILER.start(options['trace'] is not None)
   try:
     res=False
     cmd=sys.argv[1]
@@ -345,8 +541,16 @@ def main():
     if not res :
       print(usage)
   except:
-    traceback.print_exc()
-    print("Error...")
+    if r4w.OUTPUT_MODE == 'json':
+      r4w.event('error', message=traceback.format_exc().strip().split("\n")[-1])
+    else:
+      traceback.print_exc()
+      print("Error...")
+  r4w.save_mirrors()
+  if r4w.PROFILER.enabled:
+    profile_report()
+  if options['exit']:
+    sys.exit(options['exit'])
 
 ##############################
 #  M A I N